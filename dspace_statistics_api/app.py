@@ -1,16 +1,48 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
+import concurrent.futures
 import json
+import logging
 import math
+import time
 
 import falcon
-import psycopg2.extras
+import psycopg2.extensions
+import requests
 from falcon_swagger_ui import register_swaggerui_app
 
-from .config import DSPACE_STATISTICS_API_URL, VERSION
-from .database import DatabaseManager
-from .stats import get_downloads, get_views
-from .util import set_statistics_scope, validate_post_parameters
+from .config import (
+    DSPACE_STATISTICS_API_URL,
+    SNAPSHOT_URL,
+    SOLR_CHUNK_SIZE,
+    SOLR_QUERY_DEADLINE,
+    VERSION,
+)
+from .database import (
+    DatabaseManager,
+    execute_page,
+    execute_prepared,
+    get_generation,
+    get_snapshots,
+    get_total,
+)
+from .stats import (
+    get_downloads,
+    get_views,
+    get_views_and_downloads,
+    query_executor,
+    wait_for_queries,
+)
+from .util import (
+    encode_export,
+    is_not_modified,
+    response_cache,
+    set_statistics_scope,
+    validate_lookup_parameters,
+    validate_post_parameters,
+)
+
+logger = logging.getLogger(__name__)
 
 
 class RootResource:
@@ -36,7 +68,9 @@ class RootResource:
 
 class StatusResource:
     def on_get(self, req, resp):
-        message = {"version": VERSION}
+        # The response cache is per process, so these are the numbers for the
+        # worker that happened to answer this request.
+        message = {"version": VERSION, "responseCache": response_cache.stats()}
 
         resp.status = falcon.HTTP_200
         resp.media = message
@@ -66,6 +100,36 @@ class OpenAPIJSONResource:
             resp.text = json.dumps(data)
 
 
+class SnapshotsResource:
+    def on_get(self, req, resp):
+        """Handles GET requests.
+
+        Lists the snapshot files that the indexer wrote the last time it
+        updated each scope. The files themselves are served by the web server.
+        """
+        with DatabaseManager() as db:
+            db.set_session(readonly=True)
+
+            rows = get_snapshots(db)
+
+        snapshots = []
+        for scope, export_format, generation, created, filename, size, sha256 in rows:
+            snapshots.append(
+                {
+                    "scope": scope,
+                    "format": export_format,
+                    "generation": generation,
+                    "created": created.isoformat(),
+                    "url": f"{SNAPSHOT_URL}/{filename}",
+                    "size": size,
+                    "sha256": sha256,
+                }
+            )
+
+        resp.status = falcon.HTTP_200
+        resp.media = {"snapshots": snapshots}
+
+
 class AllStatisticsResource:
     @falcon.before(set_statistics_scope)
     def on_get(self, req, resp):
@@ -73,33 +137,47 @@ class AllStatisticsResource:
         # Return HTTPBadRequest if id parameter is not present and valid
         limit = req.get_param_as_int("limit", min_value=1, max_value=100) or 100
         page = req.get_param_as_int("page", min_value=0) or 0
+        # Clients walking through all results should use the nextCursor of the
+        # previous response as the "after" parameter instead of the page, which
+        # means the database doesn't have to skip all of the previous pages.
+        after = req.get_param_as_uuid("after")
         offset = limit * page
 
         with DatabaseManager() as db:
             db.set_session(readonly=True)
 
-            with db.cursor() as cursor:
-                # get total number of communities/collections/items so we can estimate the pages
-                cursor.execute(f"SELECT COUNT(id) FROM {req.context.statistics_scope}")
-                pages = math.ceil(cursor.fetchone()[0] / limit)
+            # The statistics only change when the indexer updates the table, so
+            # we don't need to query them if the client's copy is current.
+            generation = get_generation(db, req.context.statistics_scope)
+            if is_not_modified(req, resp, req.context.statistics_scope, generation):
+                return
 
-                # get statistics and use limit and offset to page through results
-                cursor.execute(
-                    f"SELECT id, views, downloads FROM {req.context.statistics_scope} ORDER BY id LIMIT %s OFFSET %s",
-                    [limit, offset],
-                )
+            # Serve the response from memory if nothing changed since the last
+            # time this page was requested
+            cache_key = (req.path, limit, page, after)
+            body = response_cache.get(cache_key, generation)
+            if body is not None:
+                resp.content_type = falcon.MEDIA_JSON
+                resp.data = body
+
+                return
+
+            # get total number of communities/collections/items so we can estimate the pages
+            pages = math.ceil(get_total(db, req.context.statistics_scope) / limit)
+
+            # Use a plain cursor, which returns rows as tuples instead of dicts
+            with db.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+                # get statistics and use the cursor, or limit and offset, to
+                # page through results
+                execute_page(cursor, req.context.statistics_scope, limit, offset, after)
 
                 # create a list to hold dicts of stats
                 statistics = []
 
                 # iterate over results and build statistics object
-                for result in cursor:
+                for id_, views, downloads in cursor:
                     statistics.append(
-                        {
-                            "id": str(result["id"]),
-                            "views": result["views"],
-                            "downloads": result["downloads"],
-                        }
+                        {"id": str(id_), "views": views, "downloads": downloads}
                     )
 
         message = {
@@ -109,7 +187,21 @@ class AllStatisticsResource:
             "statistics": statistics,
         }
 
-        resp.media = message
+        # A cursor pointing to the next page, unless this was the last one
+        if len(statistics) == limit:
+            message["nextCursor"] = statistics[-1]["id"]
+        else:
+            message["nextCursor"] = None
+
+        # The page number doesn't mean anything when using a cursor
+        if after:
+            del message["currentPage"]
+
+        body = json.dumps(message).encode()
+        response_cache.put(cache_key, generation, body)
+
+        resp.content_type = falcon.MEDIA_JSON
+        resp.data = body
 
     @falcon.before(set_statistics_scope)
     @falcon.before(validate_post_parameters)
@@ -154,30 +246,166 @@ class AllStatisticsResource:
         #   3rd set: items[200:300] would give items at indexes 200 to 239
         elements_subset: list = req.context.elements[first_element:last_element]
 
-        views: dict = get_views(
-            solr_date_string, elements_subset, req.context.views_facet_field
+        # All of the Solr queries for this request have to be done by then
+        deadline = time.monotonic() + SOLR_QUERY_DEADLINE
+
+        # Split the page into chunks that are small enough for a single Solr
+        # query and send the queries for all of them concurrently. The number
+        # of queries that actually run at the same time is bounded by the size
+        # of the query executor.
+        chunks = []
+        for start in range(0, len(elements_subset), SOLR_CHUNK_SIZE):
+            end = start + SOLR_CHUNK_SIZE
+            chunks.append(
+                submit_statistics_queries(
+                    req, solr_date_string, elements_subset[start:end], deadline
+                )
+            )
+
+        # Wait for the first chunk before we start to answer so that we can
+        # still return a proper error if Solr is down or too slow, which is
+        # also all there is to do for pages that fit in a single chunk.
+        first_chunk = wait_for_chunk(chunks, 0, deadline) if chunks else []
+
+        resp.status = falcon.HTTP_200
+
+        if len(chunks) <= 1:
+            resp.media = {
+                "currentPage": req.context.page,
+                "totalPages": pages,
+                "limit": req.context.limit,
+                "statistics": first_chunk,
+            }
+        else:
+            resp.content_type = falcon.MEDIA_JSON
+            resp.stream = stream_statistics(req, pages, chunks, first_chunk, deadline)
+
+
+def submit_statistics_queries(
+    req, solr_date_string: str, elements: list, deadline: float
+):
+    """Submit the Solr queries for the views and downloads of a chunk of the
+    POSTed elements to the query executor.
+
+    :parameter req: the request, whose context has the facet fields to query
+    :parameter solr_date_string (str): Solr date range, for example "[* TO *]"
+    :parameter elements (list): the elements in this chunk
+    :parameter deadline (float): time.monotonic() by which the queries must be done
+    :returns: A list of the futures of the queries
+    """
+    # Communities and collections use the same Solr field for views and
+    # downloads so we can get both in a single request. For items we send the
+    # views and downloads queries concurrently.
+    if req.context.views_facet_field == req.context.downloads_facet_field:
+        return [
+            query_executor.submit(
+                get_views_and_downloads,
+                solr_date_string,
+                elements,
+                req.context.views_facet_field,
+                deadline,
+            )
+        ]
+
+    return [
+        query_executor.submit(
+            get_views,
+            solr_date_string,
+            elements,
+            req.context.views_facet_field,
+            deadline,
+        ),
+        query_executor.submit(
+            get_downloads,
+            solr_date_string,
+            elements,
+            req.context.downloads_facet_field,
+            deadline,
+        ),
+    ]
+
+
+def wait_for_chunk(chunks: list, index: int, deadline: float):
+    """Wait for the queries of a chunk of the POSTed elements and combine their
+    results. If they fail the queries of the other chunks are cancelled.
+
+    :parameter chunks (list): the futures of the queries of each chunk
+    :parameter index (int): the chunk to wait for
+    :parameter deadline (float): time.monotonic() by which the queries must be done
+    :returns: A list of dicts with the id, views, and downloads of each element
+    """
+    try:
+        results = wait_for_queries(chunks[index], deadline)
+    except (concurrent.futures.TimeoutError, requests.exceptions.Timeout):
+        cancel_queries(chunks)
+
+        raise falcon.HTTPGatewayTimeout(
+            title="504 Gateway Timeout",
+            description=f"Solr did not answer within {SOLR_QUERY_DEADLINE} seconds.",
         )
-        downloads: dict = get_downloads(
-            solr_date_string, elements_subset, req.context.downloads_facet_field
+    except requests.exceptions.RequestException:
+        cancel_queries(chunks)
+
+        raise falcon.HTTPBadGateway(
+            title="502 Bad Gateway",
+            description="Failed to get statistics from Solr.",
         )
 
-        # create a list to hold dicts of stats
-        statistics = []
+    if len(results) == 1:
+        [(views, downloads)] = results
+    else:
+        views, downloads = results
 
-        # iterate over views dict to extract views and use the element id as an
-        # index to the downloads dict to extract downloads.
-        for k, v in views.items():
-            statistics.append({"id": k, "views": v, "downloads": downloads[k]})
+    # iterate over views dict to extract views and use the element id as an
+    # index to the downloads dict to extract downloads.
+    return [{"id": k, "views": v, "downloads": downloads[k]} for k, v in views.items()]
 
-        message = {
-            "currentPage": req.context.page,
-            "totalPages": pages,
-            "limit": req.context.limit,
-            "statistics": statistics,
-        }
 
-        resp.status = falcon.HTTP_200
-        resp.media = message
+def stream_statistics(
+    req, pages: int, chunks: list, first_chunk: list, deadline: float
+):
+    """Encode the response of a POST request a chunk at a time, as soon as the
+    queries of each chunk are done, in the order that the elements were POSTed.
+
+    The response has already started when a later chunk fails, so all we can do
+    then is to abort it, which the client sees as an incomplete response.
+
+    :parameter req: the request
+    :parameter pages (int): the number of pages of POSTed elements
+    :parameter chunks (list): the futures of the queries of each chunk
+    :parameter first_chunk (list): the statistics of the first chunk
+    :parameter deadline (float): time.monotonic() by which the queries must be done
+    """
+    try:
+        yield (
+            f'{{"currentPage": {req.context.page}, "totalPages": {pages}, '
+            f'"limit": {req.context.limit}, "statistics": ['
+        ).encode()
+
+        separator = ""
+        for index in range(len(chunks)):
+            statistics = (
+                first_chunk if index == 0 else wait_for_chunk(chunks, index, deadline)
+            )
+
+            if statistics:
+                yield (separator + json.dumps(statistics)[1:-1]).encode()
+                separator = ", "
+
+        yield b"]}"
+    finally:
+        # Don't leave queries for a client that went away in the executor
+        cancel_queries(chunks)
+
+
+def cancel_queries(chunks: list):
+    """Cancel the queries of all chunks that haven't started yet.
+
+    :parameter chunks (list): the futures of the queries of each chunk
+    """
+    for futures in chunks:
+        for future in futures:
+            future.cancel()
 
 
 class SingleStatisticsResource:
@@ -185,18 +413,28 @@ class SingleStatisticsResource:
     def on_get(self, req, resp, id_):
         """Handles GET requests"""
 
-        # Adapt Python’s uuid.UUID type to PostgreSQL’s uuid
-        # See: https://www.psycopg.org/docs/extras.html
-        psycopg2.extras.register_uuid()
-
         with DatabaseManager() as db:
             db.set_session(readonly=True)
 
-            with db.cursor() as cursor:
-                cursor = db.cursor()
-                cursor.execute(
-                    f"SELECT views, downloads FROM {req.context.database} WHERE id=%s",
-                    [str(id_)],
+            generation = get_generation(db, req.context.database)
+            if is_not_modified(req, resp, req.context.database, generation):
+                return
+
+            cache_key = (req.path,)
+            body = response_cache.get(cache_key, generation)
+            if body is not None:
+                resp.content_type = falcon.MEDIA_JSON
+                resp.data = body
+
+                return
+
+            # Use a plain cursor, which returns rows as tuples instead of dicts
+            with db.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+                execute_prepared(
+                    cursor,
+                    f"{req.context.database}_by_id",
+                    f"SELECT views, downloads FROM {req.context.database} WHERE id=$1",
+                    [id_],
                 )
                 if cursor.rowcount == 0:
                     raise falcon.HTTPNotFound(
@@ -204,31 +442,203 @@ class SingleStatisticsResource:
                         description=f'The {req.context.statistics_scope} with id "{str(id_)}" was not found.',
                     )
                 else:
-                    results = cursor.fetchone()
+                    views, downloads = cursor.fetchone()
 
                     statistics = {
                         "id": str(id_),
-                        "views": results["views"],
-                        "downloads": results["downloads"],
+                        "views": views,
+                        "downloads": downloads,
                     }
 
-                    resp.media = statistics
+        body = json.dumps(statistics).encode()
+        response_cache.put(cache_key, generation, body)
+
+        resp.content_type = falcon.MEDIA_JSON
+        resp.data = body
+
+
+class LookupStatisticsResource:
+    @falcon.before(set_statistics_scope)
+    @falcon.before(validate_lookup_parameters)
+    def on_post(self, req, resp):
+        """Handles POST requests.
+
+        Returns the indexed views and downloads of a list of elements from the
+        database using a single query, rather than one GET request for each
+        element. Elements that are not in the database are listed separately.
+        """
+
+        with DatabaseManager() as db:
+            db.set_session(readonly=True)
+
+            # Use a plain cursor, which returns rows as tuples instead of dicts
+            with db.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+                execute_prepared(
+                    cursor,
+                    f"{req.context.database}_lookup",
+                    f"SELECT id, views, downloads FROM {req.context.database} WHERE id = ANY($1)",
+                    [req.context.elements],
+                )
+
+                found = {id_: (views, downloads) for id_, views, downloads in cursor}
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = falcon.MEDIA_JSON
+        resp.stream = stream_lookup(req.context.elements, found)
+
+
+def stream_lookup(elements: list, found: dict):
+    """Encode the response of a lookup a chunk at a time, in the order that the
+    elements were requested, so we never hold the whole response in memory.
+
+    :parameter elements (list): UUIDs of the requested elements
+    :parameter found (dict): views and downloads of the elements that are in the database
+    """
+    chunk_size = 1000
+    missing = []
+
+    yield b'{"statistics": ['
+
+    chunk = []
+    separator = ""
+    for id_ in elements:
+        if id_ not in found:
+            missing.append(str(id_))
+            continue
+
+        views, downloads = found[id_]
+        chunk.append(
+            json.dumps({"id": str(id_), "views": views, "downloads": downloads})
+        )
+
+        if len(chunk) == chunk_size:
+            yield (separator + ", ".join(chunk)).encode()
+            chunk = []
+            separator = ", "
+
+    if chunk:
+        yield (separator + ", ".join(chunk)).encode()
+
+    yield f'], "missing": {json.dumps(missing)}}}'.encode()
+
+
+class ExportStatisticsResource:
+    # Content types of the export formats
+    formats = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+    @falcon.before(set_statistics_scope)
+    def on_get(self, req, resp):
+        """Handles GET requests.
+
+        Streams the views and downloads of every element in a scope's table,
+        one line per element, so clients can harvest all of the statistics
+        with a single request instead of paging through them.
+        """
+        export_format = req.get_param("format", default="ndjson")
+        if export_format not in self.formats:
+            raise falcon.HTTPBadRequest(
+                title="Invalid parameter",
+                description='The "format" parameter is invalid. The value must be "ndjson" or "csv".',
+            )
+
+        # Only compress the export if the client says it can decompress it
+        accept_encoding = req.get_header("Accept-Encoding", default="")
+        compress = "gzip" in [
+            encoding.split(";")[0].strip() for encoding in accept_encoding.split(",")
+        ]
+
+        with DatabaseManager() as db:
+            db.set_session(readonly=True)
+
+            generation = get_generation(db, req.context.database)
+            if is_not_modified(req, resp, req.context.database, generation):
+                return
+
+        # Clients may take a long time to download the export, so we don't keep
+        # a connection or a transaction open while they do (see ExportReader).
+        reader = ExportReader(req.context.database, generation)
+
+        resp.stream = encode_export(reader, export_format, compress)
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = self.formats[export_format]
+        resp.downloadable_as = f"{req.context.database}.{export_format}"
+        resp.vary = ["Accept-Encoding"]
+        if compress:
+            resp.set_header("Content-Encoding", "gzip")
+
+
+class ExportReader:
+    """Read the rows of a scope's table for an export in order of their ids, a
+    batch at a time, like the fetchmany() of a database cursor.
+
+    Each batch is read in its own short transaction on a connection from the
+    pool, so a client that downloads the export slowly neither holds on to a
+    connection nor stops the indexer from swapping the table. If the indexer
+    updates the table during the export we stop rather than mix the rows of
+    two generations. The status and the first rows have already been sent by
+    then, so all we can do is raise an exception, which makes the server cut
+    the response short without ending it properly, and the client has to
+    start again.
+
+    :parameter database (str): the scope's table, for example "items"
+    :parameter generation: the generation of the table when the export started
+    """
+
+    def __init__(self, database: str, generation):
+        self.database = database
+        self.generation = generation
+        self.after = None
+
+    def fetchmany(self, size: int):
+        with DatabaseManager() as db:
+            db.set_session(readonly=True)
+
+            # Use a plain cursor, which returns rows as tuples instead of dicts
+            with db.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+                execute_page(cursor, self.database, size, after=self.after)
+
+                rows = cursor.fetchall()
+
+            # The indexer updates the rows and the generation in the same
+            # transaction, so if the generation is still the same after we read
+            # the rows then they belong to it.
+            if get_generation(db, self.database) != self.generation:
+                logger.warning(
+                    f"Stopped exporting {self.database} because they were updated during the export"
+                )
+
+                raise RuntimeError(
+                    f"The {self.database} were updated during the export"
+                )
+
+        if rows:
+            self.after = rows[-1][0]
+
+        return rows
 
 
 app = application = falcon.App()
 app.add_route("/", RootResource())
 app.add_route("/status", StatusResource())
+app.add_route("/snapshots", SnapshotsResource())
 
 # Item routes
 app.add_route("/items", AllStatisticsResource())
+app.add_route("/items/lookup", LookupStatisticsResource())
+app.add_route("/items/export", ExportStatisticsResource())
 app.add_route("/item/{id_:uuid}", SingleStatisticsResource())
 
 # Community routes
 app.add_route("/communities", AllStatisticsResource())
+app.add_route("/communities/lookup", LookupStatisticsResource())
+app.add_route("/communities/export", ExportStatisticsResource())
 app.add_route("/community/{id_:uuid}", SingleStatisticsResource())
 
 # Collection routes
 app.add_route("/collections", AllStatisticsResource())
+app.add_route("/collections/lookup", LookupStatisticsResource())
+app.add_route("/collections/export", ExportStatisticsResource())
 app.add_route("/collection/{id_:uuid}", SingleStatisticsResource())
 
 # Route to the Swagger UI Openapp schema
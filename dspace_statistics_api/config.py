@@ -1,16 +1,87 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
+import datetime
 import os
 
 # Check if Solr connection information was provided in the environment
 SOLR_SERVER = os.environ.get("SOLR_SERVER", "http://localhost:8080/solr")
 
+# How to query Solr when statistics have been sharded into yearly cores. In the
+# default "distributed" mode we send one distributed query to the statistics
+# core and let Solr merge the results from each shard. In "parallel" mode we
+# query each core directly and concurrently and add up the results ourselves.
+SOLR_SHARD_MODE = os.environ.get("SOLR_SHARD_MODE", "distributed")
+
+# Maximum number of cores to query concurrently in "parallel" mode
+SOLR_SHARD_WORKERS = int(os.environ.get("SOLR_SHARD_WORKERS", "10"))
+
+# Maximum number of Solr queries for POST requests to send concurrently, and
+# how long (in seconds) a POST request may wait for all of its queries before
+# the API gives up and answers with a 504 Gateway Timeout.
+SOLR_QUERY_WORKERS = int(os.environ.get("SOLR_QUERY_WORKERS", "10"))
+SOLR_QUERY_DEADLINE = float(os.environ.get("SOLR_QUERY_DEADLINE", "30"))
+
+# Number of ids from a POST request to send to Solr in each query. Pages with
+# more ids than this are split into several queries, which are sent to Solr
+# concurrently.
+SOLR_CHUNK_SIZE = int(os.environ.get("SOLR_CHUNK_SIZE", "100"))
+
+# How long (in seconds) to keep using the list of statistics cores before asking
+# Solr for it again. New yearly shards are normally only created once a year.
+SOLR_CORES_TTL = float(os.environ.get("SOLR_CORES_TTL", "3600"))
+
+# Connections to Solr are kept alive and shared by everything in the process, up
+# to SOLR_POOL_SIZE connections at a time.
+SOLR_POOL_SIZE = int(os.environ.get("SOLR_POOL_SIZE", "10"))
+
+# How long to wait (in seconds) to connect to Solr and for Solr to answer
+SOLR_CONNECT_TIMEOUT = float(os.environ.get("SOLR_CONNECT_TIMEOUT", "5"))
+SOLR_READ_TIMEOUT = float(os.environ.get("SOLR_READ_TIMEOUT", "60"))
+
+# How many times to retry a Solr request that failed because of a connection
+# error or a 502, 503, or 504 response, waiting SOLR_RETRY_BACKOFF seconds times
+# two to the power of the number of the retry before each one.
+SOLR_RETRIES = int(os.environ.get("SOLR_RETRIES", "3"))
+SOLR_RETRY_BACKOFF = float(os.environ.get("SOLR_RETRY_BACKOFF", "0.5"))
+
+# Solr queries longer than this many characters are sent as POST requests
+SOLR_POST_THRESHOLD = int(os.environ.get("SOLR_POST_THRESHOLD", "4096"))
+
 DATABASE_NAME = os.environ.get("DATABASE_NAME", "dspacestatistics")
 DATABASE_USER = os.environ.get("DATABASE_USER", "dspacestatistics")
 DATABASE_PASS = os.environ.get("DATABASE_PASS", "dspacestatistics")
 DATABASE_HOST = os.environ.get("DATABASE_HOST", "localhost")
 DATABASE_PORT = os.environ.get("DATABASE_PORT", "5432")
 
+# Each process (for example each Gunicorn worker) keeps up to DATABASE_POOL_SIZE
+# connections to PostgreSQL open. Connections that have been idle for more than
+# DATABASE_POOL_CHECK seconds are checked before they are used again. Threads
+# give up after waiting DATABASE_POOL_TIMEOUT seconds for a connection when all
+# of them are in use.
+DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", "5"))
+DATABASE_POOL_CHECK = float(os.environ.get("DATABASE_POOL_CHECK", "30"))
+DATABASE_POOL_TIMEOUT = float(os.environ.get("DATABASE_POOL_TIMEOUT", "30"))
+
+# Number of seconds that clients and proxies may cache responses from the GET
+# endpoints without checking with the API whether the indexer has updated the
+# statistics since. Set to 0 to make them check on every request.
+CACHE_MAX_AGE = int(os.environ.get("CACHE_MAX_AGE", "60"))
+
+# Number of serialized responses from the GET endpoints that each process keeps
+# in memory. Responses are only served from memory until the indexer updates
+# the statistics they came from. Set to 0 to disable the cache.
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "1000"))
+
+# Maximum number of ids that can be looked up in a single POST request to the
+# /items/lookup, /communities/lookup, and /collections/lookup endpoints.
+LOOKUP_MAX_IDS = int(os.environ.get("LOOKUP_MAX_IDS", "10000"))
+
+# Maximum value of the "limit" parameter in POST requests to the /items,
+# /communities, and /collections endpoints, and the maximum size (in bytes) of
+# the body of those requests and of the requests to the lookup endpoints.
+POST_MAX_LIMIT = int(os.environ.get("POST_MAX_LIMIT", "5000"))
+POST_MAX_BODY = int(os.environ.get("POST_MAX_BODY", "1048576"))
+
 # URL to DSpace Statistics API, which will be used as a prefix to API calls in
 # the Swagger UI. An empty string will allow this to work out of the box in a
 # local development environment, but for production it should be set to a value
@@ -18,6 +89,72 @@ DATABASE_PORT = os.environ.get("DATABASE_PORT", "5432")
 # the vanilla DSpace REST API.
 DSPACE_STATISTICS_API_URL = os.environ.get("DSPACE_STATISTICS_API_URL", "")
 
+# How the indexer retrieves facet counts from Solr. The default "stream" mode
+# requests every facet for a scope in a single request and parses the response
+# incrementally as it arrives. The "paged" mode is the legacy behavior of
+# requesting facets 100 at a time using facet.offset.
+INDEXER_FACET_MODE = os.environ.get("INDEXER_FACET_MODE", "stream")
+
+# In "paged" mode the indexer adapts the number of facets it requests per page.
+# It starts with INDEXER_PAGE_SIZE and doubles the page size (up to the maximum)
+# while Solr answers faster than the target number of seconds and with less than
+# the target number of bytes, and halves it (down to the minimum) when a page is
+# slower or bigger than that, or when the request times out.
+INDEXER_PAGE_SIZE = int(os.environ.get("INDEXER_PAGE_SIZE", "1000"))
+INDEXER_PAGE_SIZE_MIN = int(os.environ.get("INDEXER_PAGE_SIZE_MIN", "100"))
+INDEXER_PAGE_SIZE_MAX = int(os.environ.get("INDEXER_PAGE_SIZE_MAX", "100000"))
+INDEXER_PAGE_TARGET_SECONDS = float(os.environ.get("INDEXER_PAGE_TARGET_SECONDS", "2"))
+INDEXER_PAGE_TARGET_BYTES = int(os.environ.get("INDEXER_PAGE_TARGET_BYTES", "5242880"))
+INDEXER_PAGE_TIMEOUT = float(os.environ.get("INDEXER_PAGE_TIMEOUT", "60"))
+
+# After a scope has been indexed once the indexer only counts the events since
+# the last run and adds them to the existing counts. Every so often (in hours)
+# it recounts everything in order to catch events that have been deleted or
+# flagged as bots since they were counted. Set to 0 to always recount.
+INDEXER_RECONCILE_INTERVAL = datetime.timedelta(
+    hours=float(os.environ.get("INDEXER_RECONCILE_INTERVAL", "24"))
+)
+
+# How far behind the current time (in seconds) the indexer stays so that it
+# doesn't miss events that Solr has not committed yet.
+INDEXER_WATERMARK_LAG = int(os.environ.get("INDEXER_WATERMARK_LAG", "300"))
+
+# When the indexer recounts everything it builds a new copy of each table and
+# swaps it in place of the old one, so that readers always see a consistent
+# snapshot and the tables don't accumulate dead rows. Incremental runs always
+# update the changed rows in place. Set to "false" to update the tables in
+# place on full recounts too.
+INDEXER_TABLE_SWAP = os.environ.get("INDEXER_TABLE_SWAP", "true") == "true"
+
+# Swapping a table has to wait until nobody is reading it, and every query that
+# arrives in the meantime has to wait for the swap. The indexer gives up waiting
+# after INDEXER_SWAP_LOCK_TIMEOUT seconds so the API isn't blocked for longer,
+# and tries again up to INDEXER_SWAP_RETRIES times.
+INDEXER_SWAP_LOCK_TIMEOUT = float(os.environ.get("INDEXER_SWAP_LOCK_TIMEOUT", "2"))
+INDEXER_SWAP_RETRIES = int(os.environ.get("INDEXER_SWAP_RETRIES", "10"))
+
+# When statistics have been sharded into yearly cores (for example statistics-
+# 2018) the indexer stores the totals of each yearly core in the database and
+# only counts a yearly core again when its Lucene index version changes, so a
+# normal run only has to facet the current statistics core. Set to "false" to
+# count every core on every run.
+INDEXER_FROZEN_SHARDS = os.environ.get("INDEXER_FROZEN_SHARDS", "true") == "true"
+
+# Number of indexing jobs (one per scope and metric) to run concurrently
+INDEXER_WORKERS = int(os.environ.get("INDEXER_WORKERS", "3"))
+
+# How often (in seconds) the indexer starts a run when it is running as a daemon
+INDEXER_INTERVAL = float(os.environ.get("INDEXER_INTERVAL", "900"))
+
+# Directory where the indexer writes gzipped NDJSON and CSV snapshots of each
+# scope's table after it updates them, for a web server like nginx to serve
+# directly. Leave empty to not write snapshots. The API advertises them using
+# SNAPSHOT_URL as the prefix of their URLs, and the indexer keeps the files of
+# the last SNAPSHOT_KEEP generations so that downloads in progress don't break.
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "")
+SNAPSHOT_URL = os.environ.get("SNAPSHOT_URL", f"{DSPACE_STATISTICS_API_URL}/snapshots")
+SNAPSHOT_KEEP = int(os.environ.get("SNAPSHOT_KEEP", "2"))
+
 VERSION = "1.4.4-dev"
 
 # vim: set sw=4 ts=4 expandtab:
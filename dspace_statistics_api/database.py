@@ -1,38 +1,307 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
+import os
+import threading
+import time
+
 import falcon
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 import psycopg2.extras
 
 from .config import (
     DATABASE_HOST,
     DATABASE_NAME,
     DATABASE_PASS,
+    DATABASE_POOL_CHECK,
+    DATABASE_POOL_SIZE,
+    DATABASE_POOL_TIMEOUT,
     DATABASE_PORT,
     DATABASE_USER,
 )
 
+# Adapt Python’s uuid.UUID type to PostgreSQL’s uuid
+# See: https://www.psycopg.org/docs/extras.html
+psycopg2.extras.register_uuid()
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """A database connection that remembers which statements have been
+    prepared on it and when it was last used."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection was returned to the pool in time."""
+
+
+class ConnectionPool:
+    """A pool of database connections for the current process.
+
+    Connections are opened when they are first needed and kept open for the
+    next request, up to DATABASE_POOL_SIZE of them. Threads that need a con-
+    nection when all of them are in use wait up to DATABASE_POOL_TIMEOUT
+    seconds for one to be returned.
+    """
+
+    def __init__(self, connection_uri: str, size: int):
+        self.connection_uri = connection_uri
+        self.idle = []
+        self.lock = threading.Lock()
+        self.available = threading.BoundedSemaphore(size)
+
+    def getconn(self):
+        if not self.available.acquire(timeout=DATABASE_POOL_TIMEOUT):
+            raise PoolTimeoutError(
+                f"All {DATABASE_POOL_SIZE} database connections were in use for {DATABASE_POOL_TIMEOUT} seconds"
+            )
+
+        try:
+            while True:
+                with self.lock:
+                    connection = self.idle.pop() if self.idle else None
+
+                if connection is None:
+                    return psycopg2.connect(
+                        self.connection_uri,
+                        connection_factory=PooledConnection,
+                        cursor_factory=psycopg2.extras.DictCursor,
+                    )
+
+                # Make sure that a connection that has been idle for a while
+                # wasn't closed by PostgreSQL (for example after a restart).
+                if time.monotonic() - connection.last_used < DATABASE_POOL_CHECK:
+                    return connection
+
+                try:
+                    with connection.cursor() as cursor:
+                        cursor.execute("SELECT 1")
+                    connection.rollback()
+
+                    return connection
+                except psycopg2.Error:
+                    connection.close()
+        except BaseException:
+            self.available.release()
+            raise
+
+    def putconn(self, connection, close: bool = False):
+        try:
+            if close or connection.closed:
+                connection.close()
+
+                return
+
+            # Leave the connection the way we found it for the next user, but
+            # keep it open along with its prepared statements.
+            connection.rollback()
+            connection.autocommit = False
+            connection.isolation_level = None
+            connection.readonly = None
+            connection.deferrable = None
+            connection.last_used = time.monotonic()
+
+            with self.lock:
+                self.idle.append(connection)
+        except psycopg2.Error:
+            connection.close()
+        finally:
+            self.available.release()
+
+
+# The pool for the current process. Gunicorn forks its workers after loading
+# the application, so each worker has to open its own connections rather than
+# share the ones of the parent process.
+pool = None
+pool_pid = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    global pool, pool_pid
+
+    with pool_lock:
+        if pool is None or pool_pid != os.getpid():
+            pool = ConnectionPool(
+                f"dbname={DATABASE_NAME} user={DATABASE_USER} password={DATABASE_PASS} host={DATABASE_HOST} port={DATABASE_PORT}",
+                DATABASE_POOL_SIZE,
+            )
+            pool_pid = os.getpid()
+
+        return pool
+
 
 class DatabaseManager:
     """Manage database connection."""
 
-    def __init__(self):
-        self._connection_uri = f"dbname={DATABASE_NAME} user={DATABASE_USER} password={DATABASE_PASS} host={DATABASE_HOST} port={DATABASE_PORT}"
-
     def __enter__(self):
+        self._pool = get_pool()
+
         try:
-            self._connection = psycopg2.connect(
-                self._connection_uri, cursor_factory=psycopg2.extras.DictCursor
-            )
+            self._connection = self._pool.getconn()
         except psycopg2.OperationalError:
             title = "500 Internal Server Error"
             description = "Could not connect to database"
             raise falcon.HTTPInternalServerError(title, description)
+        except PoolTimeoutError:
+            title = "503 Service Unavailable"
+            description = "All database connections are in use"
+            raise falcon.HTTPServiceUnavailable(title=title, description=description)
 
         return self._connection
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        self._connection.close()
+        # Don't return a connection to the pool if something went wrong with
+        # it, for example if we lost the connection to the database.
+        self._pool.putconn(
+            self._connection,
+            close=exc_type is not None
+            and issubclass(
+                exc_type, (psycopg2.OperationalError, psycopg2.InterfaceError)
+            ),
+        )
+
+
+def execute_prepared(cursor, name: str, query: str, parameters: list):
+    """Execute a query as a prepared statement, preparing it first if this is
+    the first time we use it on this connection. PostgreSQL then only has to
+    parse and plan the query once per connection.
+
+    :parameter cursor: a database cursor
+    :parameter name (str): name of the prepared statement, for example "items_by_id"
+    :parameter query (str): the query, with $1, $2, etc for the parameters
+    :parameter parameters (list): the values of the parameters
+    """
+    if name not in cursor.connection.prepared:
+        cursor.execute(f"PREPARE {name} AS {query}")
+        cursor.connection.prepared.add(name)
+
+    placeholders = ", ".join(["%s"] * len(parameters))
+    cursor.execute(f"EXECUTE {name} ({placeholders})", parameters)
+
+
+def execute_page(cursor, scope: str, limit: int, offset: int = 0, after=None):
+    """Select a page of the views and downloads of a scope's elements in order
+    of their ids, either the elements after an id (keyset pagination, which
+    is fast however deep the page is) or at an offset.
+
+    :parameter cursor: a database cursor
+    :parameter scope (str): the scope's table, for example "items"
+    :parameter limit (int): the number of elements in the page
+    :parameter offset (int): the number of elements to skip if after is None
+    :parameter after (str): the id of the last element of the previous page
+    """
+    if after:
+        execute_prepared(
+            cursor,
+            f"{scope}_after",
+            f"SELECT id, views, downloads FROM {scope} WHERE id > $1 ORDER BY id LIMIT $2",
+            [after, limit],
+        )
+    else:
+        execute_prepared(
+            cursor,
+            f"{scope}_page",
+            f"SELECT id, views, downloads FROM {scope} ORDER BY id LIMIT $1 OFFSET $2",
+            [limit, offset],
+        )
+
+
+def get_generation(db, scope: str):
+    """Get the generation of a scope's table, which the indexer increments
+    every time it updates the table, and when it did so.
+
+    :parameter db: a database connection
+    :parameter scope (str): the scope's table, for example "items"
+    :returns: A tuple of the generation and when it was indexed, or None if the
+        scope hasn't been indexed since the generations table was added
+    """
+    # Use a plain cursor, which returns rows as tuples instead of dicts
+    with db.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        try:
+            execute_prepared(
+                cursor,
+                "generations_generation",
+                "SELECT generation, indexed FROM generations WHERE scope=$1",
+                [scope],
+            )
+        except psycopg2.errors.UndefinedTable:
+            # The indexer hasn't created the table yet
+            db.rollback()
+
+            return None
+
+        return cursor.fetchone()
+
+
+def get_snapshots(db):
+    """Get the snapshot files that the indexer wrote most recently.
+
+    :parameter db: a database connection
+    :returns: A list of the scope, format, generation, creation time, file name,
+        size, and SHA-256 of each snapshot
+    """
+    # Use a plain cursor, which returns rows as tuples instead of dicts
+    with db.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        try:
+            cursor.execute(
+                """SELECT scope, format, generation, created, filename, size, sha256
+                   FROM snapshots ORDER BY scope, format"""
+            )
+        except psycopg2.errors.UndefinedTable:
+            # The indexer hasn't created the table yet
+            db.rollback()
+
+            return []
+
+        return cursor.fetchall()
+
+
+def get_total(db, scope: str):
+    """Get the number of rows in a scope's table without counting them.
+
+    The indexer stores the number of rows in the generations table every time
+    it updates a scope. If the scope hasn't been indexed since the table was
+    added we use PostgreSQL's estimate of the number of rows instead, and only
+    count them if there is no estimate yet either.
+
+    :parameter db: a database connection
+    :parameter scope (str): the scope's table, for example "items"
+    :returns: The number of rows in the table
+    """
+    # Use a plain cursor, which returns rows as tuples instead of dicts
+    with db.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        try:
+            execute_prepared(
+                cursor,
+                "generations_total",
+                "SELECT total FROM generations WHERE scope=$1",
+                [scope],
+            )
+        except psycopg2.errors.UndefinedTable:
+            # The indexer hasn't created the table yet
+            db.rollback()
+        else:
+            if cursor.rowcount > 0:
+                return cursor.fetchone()[0]
+
+        # PostgreSQL updates the estimate whenever the table is analyzed, and it
+        # is -1 (or 0 in older versions) if the table was never analyzed.
+        cursor.execute(
+            "SELECT reltuples::BIGINT FROM pg_class WHERE oid=%s::regclass", [scope]
+        )
+        estimate = cursor.fetchone()[0]
+        if estimate > 0:
+            return estimate
+
+        cursor.execute(f"SELECT COUNT(id) FROM {scope}")
+
+        return cursor.fetchone()[0]
 
 
 # vim: set sw=4 ts=4 expandtab:
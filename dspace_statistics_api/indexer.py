@@ -12,220 +12,1418 @@
 #
 # See: https://wiki.duraspace.org/display/DSPACE/Solr
 
-import math
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from xml.etree import ElementTree
 
+import psycopg2.errors
+import psycopg2.extensions
 import psycopg2.extras
 import requests
 
-from .config import SOLR_SERVER
+from .config import (
+    DATABASE_POOL_SIZE,
+    INDEXER_FACET_MODE,
+    INDEXER_FROZEN_SHARDS,
+    INDEXER_INTERVAL,
+    INDEXER_PAGE_SIZE,
+    INDEXER_PAGE_SIZE_MAX,
+    INDEXER_PAGE_SIZE_MIN,
+    INDEXER_PAGE_TARGET_BYTES,
+    INDEXER_PAGE_TARGET_SECONDS,
+    INDEXER_PAGE_TIMEOUT,
+    INDEXER_RECONCILE_INTERVAL,
+    INDEXER_SWAP_LOCK_TIMEOUT,
+    INDEXER_SWAP_RETRIES,
+    INDEXER_TABLE_SWAP,
+    INDEXER_WATERMARK_LAG,
+    INDEXER_WORKERS,
+    SNAPSHOT_DIR,
+    SNAPSHOT_KEEP,
+    SOLR_SHARD_MODE,
+)
 from .database import DatabaseManager
-from .util import get_statistics_shards
+from .solr import solr_request
+from .util import encode_export, get_statistics_core_versions, get_statistics_shards
 
+# Lock to keep the progress messages of concurrent jobs from interleaving
+log_lock = threading.Lock()
 
-def index_views(indexType: str, facetField: str):
-    # get total number of distinct facets for items with a minimum of 1 view,
-    # otherwise Solr returns all kinds of weird ids that are actually not in
-    # the database. Also, stats are expensive, but we need stats.calcdistinct
-    # so we can get the countDistinct summary to calculate how many pages of
-    # results we have.
-    #
-    # see: https://lucene.apache.org/solr/guide/6_6/the-stats-component.html
+
+def log(message: str):
+    with log_lock:
+        print(message, flush=True)
+
+
+# Solr queries for the events counted by each metric
+metric_queries = {
+    "views": "type:2",
+    "downloads": "type:0 AND bundleName:ORIGINAL",
+}
+
+
+def facet_params(facetField: str, metrics: tuple, limit: int, offset: int = 0):
+    """Build the Solr parameters to facet by a field.
+
+    If we are indexing a single metric we use a regular field facet, but for
+    several metrics we use the JSON Facet API with a query sub-facet for each
+    metric so that Solr counts all of them in a single pass.
+
+    :parameter facetField (str): Solr field to facet by, for example "id"
+    :parameter metrics (tuple): metrics to count, for example ("views",)
+    :parameter limit (int): maximum number of facets to return (-1 for all)
+    :parameter offset (int): number of facets to skip
+    :returns: A dict of Solr query parameters
+    """
+    if len(metrics) == 1:
+        return {
+            "facet": "true",
+            "facet.field": facetField,
+            "facet.mincount": 1,
+            "facet.limit": limit,
+            "facet.offset": offset,
+            "facet.sort": "index",
+        }
+
+    json_facet = {
+        facetField: {
+            "type": "terms",
+            "field": facetField,
+            "limit": limit,
+            "offset": offset,
+            "mincount": 1,
+            "sort": "index asc",
+            "facet": {
+                metric: {"type": "query", "q": metric_queries[metric]}
+                for metric in metrics
+            },
+        }
+    }
+
+    return {"json.facet": json.dumps(json_facet)}
+
+
+def stream_facets(
+    indexType: str, metrics: tuple, facetField: str, solr_query: dict, core: str
+):
+    """Request all facets for a field from Solr in a single request and yield
+    the ids and counts as the response arrives.
+
+    Solr returns the facets sorted by index (ie, the id itself) so it never
+    has to compute and skip an offset, and we parse the XML response with an
+    incremental parser so memory use stays flat regardless of how many facets
+    there are.
+
+    :parameter indexType (str): type of indexing, for example "items"
+    :parameter metrics (tuple): metrics to count, for example ("views",)
+    :parameter facetField (str): Solr field to facet by, for example "id"
+    :parameter solr_query (dict): Solr query parameters (q, fq, etc)
+    :parameter core (str): Solr core to query, for example "statistics"
+    :returns: A generator of tuples of an id and a count for each metric
+    """
     solr_query_params = {
-        "q": f"type:2 AND {facetField}:/.{{36}}/",
-        "fq": "-isBot:true AND statistics_type:view",
-        "fl": facetField,
-        "facet": "true",
-        "facet.field": facetField,
-        "facet.mincount": 1,
-        "facet.limit": 1,
-        "facet.offset": 0,
-        "stats": "true",
-        "stats.field": facetField,
-        "stats.calcdistinct": "true",
-        "shards": shards,
+        **solr_query,
+        **facet_params(facetField, metrics, -1),
         "rows": 0,
-        "wt": "json",
+        "wt": "xml",
     }
 
-    solr_url = SOLR_SERVER + "/statistics/select"
+    log(
+        f"{indexType}: indexing {' and '.join(metrics)} from {core} (streaming all facets)"
+    )
 
-    res = requests.get(solr_url, params=solr_query_params)
+    res = solr_request(f"{core}/select", solr_query_params, stream=True)
 
+    # Close the response even if the parsing fails or the caller stops half
+    # way, so its connection is released (or dropped if it wasn't read to the
+    # end) instead of staying open until the response is garbage collected.
     try:
-        # get total number of distinct facets (countDistinct)
-        results_totalNumFacets = res.json()["stats"]["stats_fields"][facetField][
-            "countDistinct"
-        ]
-    except TypeError:
-        print(f"{indexType}: no views, exiting.")
-
-        exit(0)
-
-    # divide results into "pages" and round up to next integer
-    results_per_page = 100
-    results_num_pages = math.ceil(results_totalNumFacets / results_per_page)
+        res.raise_for_status()
+
+        # Let urllib3 decompress the response if Solr sent it gzipped
+        res.raw.decode_content = True
+
+        # Keep track of the names of the <lst> and <arr> elements we are inside so
+        # we know when we are looking at facet counts. Regular field facets look
+        # like this:
+        #
+        #   <lst name="facet_counts">
+        #     <lst name="facet_fields">
+        #       <lst name="id">
+        #         <int name="fd8a46d5-1480-4e69-b187-cd3db96d8e4d">4</int>
+        #
+        # ... and JSON facets look like this:
+        #
+        #   <lst name="facets">
+        #     <lst name="owningComm">
+        #       <arr name="buckets">
+        #         <lst>
+        #           <str name="val">bde7139c-d321-46bb-aef6-ae70799e5edb</str>
+        #           <long name="count">12</long>
+        #           <lst name="views"><long name="count">9</long></lst>
+        #           <lst name="downloads"><long name="count">3</long></lst>
+        path = []
+        facet_list = None
+
+        for event, element in ElementTree.iterparse(res.raw, events=("start", "end")):
+            if element.tag not in ("lst", "arr"):
+                # Solr uses <int> for facet counts, but older versions used <long>
+                if (
+                    event == "end"
+                    and element.tag in ("int", "long")
+                    and path[-2:] == ["facet_fields", facetField]
+                ):
+                    yield element.get("name"), int(element.text)
+
+                    # Discard the elements we have already seen
+                    facet_list.clear()
+
+                continue
+
+            if event == "start":
+                path.append(element.get("name"))
+
+                if path[-2:] in (["facet_fields", facetField], [facetField, "buckets"]):
+                    facet_list = element
+
+                continue
+
+            if path[-4:] == ["facets", facetField, "buckets", None]:
+                counts = [
+                    element.findtext(f"lst[@name='{metric}']/*[@name='count']")
+                    for metric in metrics
+                ]
+
+                yield (element.findtext("str[@name='val']"), *map(int, counts))
+
+                facet_list.clear()
+
+            path.pop()
+    finally:
+        res.close()
+
+
+def page_facets(
+    indexType: str, metrics: tuple, facetField: str, solr_query: dict, core: str
+):
+    """Request facets for a field from Solr one "page" at a time using Solr's
+    facet.offset parameter.
+
+    :parameter indexType (str): type of indexing, for example "items"
+    :parameter metrics (tuple): metrics to count, for example ("views",)
+    :parameter facetField (str): Solr field to facet by, for example "id"
+    :parameter solr_query (dict): Solr query parameters (q, fq, etc)
+    :parameter core (str): Solr core to query, for example "statistics"
+    :returns: A generator of tuples of an id and a count for each metric
+    """
+    # We don't know how many facets there are, so we keep requesting pages of
+    # results until Solr returns a page that isn't full. Asking Solr for the
+    # number of distinct values with stats.calcdistinct is one of the most ex-
+    # pensive queries we can send, so we don't.
+    #
+    # The size of the pages adapts to how quickly Solr answers, so scopes with
+    # few facets are fetched in a single request and scopes with many facets
+    # in as few requests as Solr can comfortably handle.
+    results_per_page = INDEXER_PAGE_SIZE
+    results_offset = 0
     results_current_page = 0
 
+    while True:
+        # "pages" are zero based, but one based is more human readable
+        log(
+            f"{indexType}: indexing {' and '.join(metrics)} from {core} (page {results_current_page + 1}, {results_per_page} per page)"
+        )
+
+        solr_query_params = {
+            **solr_query,
+            **facet_params(facetField, metrics, results_per_page, results_offset),
+            "rows": 0,
+            "wt": "json",
+            "json.nl": "map",  # return facets as a dict instead of a flat list
+        }
+
+        start = time.monotonic()
+
+        try:
+            res = solr_request(
+                f"{core}/select", solr_query_params, read_timeout=INDEXER_PAGE_TIMEOUT
+            )
+            res.raise_for_status()
+        except requests.exceptions.Timeout:
+            # Try the same page again with a smaller page size, unless it is
+            # as small as it gets already.
+            if results_per_page <= INDEXER_PAGE_SIZE_MIN:
+                raise
+
+            results_per_page = max(results_per_page // 2, INDEXER_PAGE_SIZE_MIN)
+
+            log(
+                f"{indexType}: page {results_current_page + 1} timed out, retrying with {results_per_page} per page"
+            )
+
+            continue
+
+        elapsed = time.monotonic() - start
+
+        if len(metrics) == 1:
+            # Solr returns facets as a dict of dicts (see json.nl parameter)
+            facets = res.json()["facet_counts"]["facet_fields"][facetField]
+            # iterate over the facetField dict and get the ids and counts
+            yield from facets.items()
+        else:
+            # Solr leaves the facet out of the response if nothing matched
+            facets = res.json()["facets"].get(facetField, {"buckets": []})["buckets"]
+            # iterate over the buckets and get the ids and each metric's count
+            for bucket in facets:
+                yield (bucket["val"], *[bucket[metric]["count"] for metric in metrics])
+
+        # A page that isn't full is the last one
+        if len(facets) < results_per_page:
+            break
+
+        results_offset += len(facets)
+        results_current_page += 1
+
+        # Grow the pages while Solr stays well within the targets and shrink
+        # them as soon as it doesn't.
+        if (
+            elapsed > INDEXER_PAGE_TARGET_SECONDS
+            or len(res.content) > INDEXER_PAGE_TARGET_BYTES
+        ):
+            results_per_page = max(results_per_page // 2, INDEXER_PAGE_SIZE_MIN)
+        elif (
+            elapsed < INDEXER_PAGE_TARGET_SECONDS / 2
+            and len(res.content) < INDEXER_PAGE_TARGET_BYTES / 2
+        ):
+            results_per_page = min(results_per_page * 2, INDEXER_PAGE_SIZE_MAX)
+
+
+class FacetReader:
+    """A file-like object that formats rows of facets as lines of text for
+    PostgreSQL's COPY FROM STDIN, reading them from Solr only as fast as the
+    database consumes them.
+    """
+
+    def __init__(self, indexType: str, metrics: tuple, facets):
+        self.indexType = indexType
+        self.metrics = metrics
+        self.facets = facets
+        self.total = 0
+
+    def read(self, size: int = -1) -> str:
+        lines = []
+        length = 0
+
+        for facet in self.facets:
+            line = "\t".join(map(str, facet)) + "\n"
+            lines.append(line)
+            length += len(line)
+
+            self.total += 1
+            if self.total % 100000 == 0:
+                log(
+                    f"{self.indexType}: indexed {' and '.join(self.metrics)} for {self.total} ids"
+                )
+
+            if 0 < size <= length:
+                break
+
+        return "".join(lines)
+
+
+class RunContext:
+    """What the jobs of an indexer run need to know about Solr and about the
+    point in time they are counting up to.
+
+    The yearly shards are read only once DSpace's stats-util has created them,
+    so by default we only count the statistics core and keep the totals of
+    each yearly shard in the database, counting a shard again only if its
+    index has changed. In "parallel" shard mode we run each job against each
+    of the statistics cores directly and add up their counts when we merge
+    the staging table. Otherwise each job sends a distributed query to the
+    statistics core.
+
+    :parameter core_versions (dict): the version of each statistics core's index
+    :parameter versions_read (datetime): when we got the versions from Solr
+    :parameter indexing_until (datetime): point in time to count events up to
+    """
+
+    def __init__(
+        self,
+        core_versions: dict,
+        versions_read: datetime.datetime,
+        indexing_until: datetime.datetime,
+    ):
+        self.core_versions = core_versions
+        self.versions_read = versions_read
+        self.indexing_until = indexing_until
+        self.frozen_shards = {}
+
+        if INDEXER_FROZEN_SHARDS:
+            self.frozen_shards = {
+                core: version
+                for core, version in core_versions.items()
+                if core != "statistics"
+            }
+
+            self.cores = ["statistics"]
+            self.shards = ""
+        elif SOLR_SHARD_MODE == "parallel":
+            self.cores = list(core_versions)
+            self.shards = ""
+        else:
+            self.cores = ["statistics"]
+            self.shards = get_statistics_shards(list(core_versions))
+
+
+def get_stale_shards(context: RunContext, cursor, indexType: str, metrics: tuple):
+    """Find the frozen shards whose totals for a scope are missing or were
+    counted from an older version of the shard's index.
+
+    :parameter context (RunContext): the run this is part of
+    :parameter cursor: a database cursor
+    :parameter indexType (str): type of indexing, for example "items"
+    :parameter metrics (tuple): metrics to count, for example ("views",)
+    :returns: A list of shards that need to be counted again
+    """
+    cursor.execute(
+        "SELECT shard, metric, version FROM shard_versions WHERE scope=%s AND metric=ANY(%s)",
+        [indexType, list(metrics)],
+    )
+    versions = {(row["shard"], row["metric"]): row["version"] for row in cursor}
+
+    # Solr increments a core's index version every time something is written
+    # to it, so an unchanged version means that the totals are still correct.
+    return [
+        shard
+        for shard, version in context.frozen_shards.items()
+        if version is None
+        or any(versions.get((shard, metric)) != version for metric in metrics)
+    ]
+
+
+def is_unchanged(context: RunContext, cursor, indexType: str):
+    """Check if any of the Solr statistics cores changed since we last indexed
+    a scope.
+
+    :parameter context (RunContext): the run this is part of
+    :parameter cursor: a database cursor
+    :parameter indexType (str): type of indexing, for example "items"
+    :returns: True if the scope's counts are still up to date and it isn't due
+        for a full recount
+    """
+    cursor.execute(
+        "SELECT core, version, seen FROM core_versions WHERE scope=%s", [indexType]
+    )
+    rows = cursor.fetchall()
+    versions = {row["core"]: row["version"] for row in rows}
+
+    cursor.execute(
+        "SELECT MIN(watermark), MIN(reconciled) FROM watermarks WHERE scope=%s",
+        [indexType],
+    )
+    watermark, reconciled = cursor.fetchone()
+
+    # Solr increments a core's index version on every commit that changes it,
+    # so if no core was added, removed, or changed then counting again would
+    # give the same result. However, we stay INDEXER_WATERMARK_LAG behind the
+    # time we read the versions, so the events with a timestamp between the
+    # watermark and the time we first saw the versions are in the versions but
+    # not counted yet. We still recount everything every
+    # INDEXER_RECONCILE_INTERVAL, as get_indexing_window() would.
+    return (
+        None not in context.core_versions.values()
+        and versions == context.core_versions
+        and watermark is not None
+        and all(row["seen"] is not None and row["seen"] <= watermark for row in rows)
+        and reconciled > context.indexing_until - INDEXER_RECONCILE_INTERVAL
+    )
+
+
+def get_indexing_window(context: RunContext, cursor, indexType: str, metrics: tuple):
+    """Work out which events we need to count for a scope.
+
+    If the scope has been indexed before and its last full reconcile is newer
+    than INDEXER_RECONCILE_INTERVAL then we only need the events that happened
+    since the scope's watermark, which we add to the existing counts. Other-
+    wise we recount everything from the beginning of time, which catches any
+    events that have since been deleted or flagged as bots.
+
+    :parameter context (RunContext): the run this is part of
+    :parameter cursor: a database cursor
+    :parameter indexType (str): type of indexing, for example "items"
+    :parameter metrics (tuple): metrics to count, for example ("views",)
+    :returns: A tuple of the watermark to count from (None for a full recount)
+        and the time of the last full recount
+    """
+    cursor.execute(
+        "SELECT watermark, reconciled FROM watermarks WHERE scope=%s AND metric=ANY(%s)",
+        [indexType, list(metrics)],
+    )
+    watermarks = cursor.fetchall()
+
+    # The totals of the frozen shards are added to the counts when we recount
+    # everything, so if a shard was added, changed, or removed since then the
+    # counts are out of date.
+    cursor.execute(
+        "SELECT DISTINCT shard FROM shard_versions WHERE scope=%s AND metric=ANY(%s)",
+        [indexType, list(metrics)],
+    )
+    removed_shards = {row["shard"] for row in cursor.fetchall()} - set(
+        context.frozen_shards
+    )
+
+    if removed_shards or get_stale_shards(context, cursor, indexType, metrics):
+        return None, context.indexing_until
+
+    # We can only count the metrics of a scope incrementally if they were all
+    # indexed up to the same point in time.
+    if (
+        len(watermarks) < len(metrics)
+        or len({tuple(watermark) for watermark in watermarks}) > 1
+        or watermarks[0]["reconciled"] is None
+        or watermarks[0]["reconciled"]
+        <= context.indexing_until - INDEXER_RECONCILE_INTERVAL
+    ):
+        return None, context.indexing_until
+
+    return watermarks[0]["watermark"], watermarks[0]["reconciled"]
+
+
+def get_facets(
+    context: RunContext,
+    indexType: str,
+    metrics: tuple,
+    facetField: str,
+    core: str,
+    fq: list,
+):
+    """Get the facet counts for a field from a Solr core.
+
+    :parameter context (RunContext): the run this is part of
+    :parameter indexType (str): type of indexing, for example "items"
+    :parameter metrics (tuple): metrics to count, for example ("views",)
+    :parameter facetField (str): Solr field to facet by, for example "id"
+    :parameter core (str): Solr core to query, for example "statistics"
+    :parameter fq (list): additional Solr filter queries, for example the time
+    :returns: A generator of tuples of an id and a count for each metric
+    """
+    solr_query = {
+        "q": f"{facetField}:/.{{36}}/",
+        "fq": [
+            "-isBot:true AND statistics_type:view",
+            " OR ".join(f"({metric_queries[metric]})" for metric in metrics),
+            *fq,
+        ],
+    }
+
+    # Only a query to the statistics core is distributed to the yearly shards.
+    # This is empty in "parallel" shard mode and when the yearly shards are
+    # frozen.
+    if core == "statistics":
+        solr_query["shards"] = context.shards
+
+    if INDEXER_FACET_MODE == "paged":
+        return page_facets(indexType, metrics, facetField, solr_query, core)
+    else:
+        return stream_facets(indexType, metrics, facetField, solr_query, core)
+
+
+def index_frozen_shard(
+    context: RunContext,
+    indexType: str,
+    metrics: tuple,
+    facetField: str,
+    shard: str,
+    version: int,
+):
+    """Count everything in a frozen yearly shard and store the shard's totals
+    along with the version of its index.
+
+    :parameter context (RunContext): the run this is part of
+    :parameter indexType (str): type of indexing, for example "items"
+    :parameter metrics (tuple): metrics to count, for example ("views",)
+    :parameter facetField (str): Solr field to facet by, for example "id"
+    :parameter shard (str): Solr core to count, for example "statistics-2018"
+    :parameter version (int): the version of the shard's Lucene index
+    """
+    log(f"{indexType}: counting all {' and '.join(metrics)} in {shard}")
+
+    facets = get_facets(context, indexType, metrics, facetField, shard, [])
+    facet_reader = FacetReader(indexType, metrics, facets)
+
     with DatabaseManager() as db:
         with db.cursor() as cursor:
-            # create an empty list to store values for batch insertion
-            data = []
-
-            while results_current_page <= results_num_pages:
-                # "pages" are zero based, but one based is more human readable
-                print(
-                    f"{indexType}: indexing views (page {results_current_page + 1} of {results_num_pages + 1})"
-                )
-
-                solr_query_params = {
-                    "q": f"type:2 AND {facetField}:/.{{36}}/",
-                    "fq": "-isBot:true AND statistics_type:view",
-                    "fl": facetField,
-                    "facet": "true",
-                    "facet.field": facetField,
-                    "facet.mincount": 1,
-                    "facet.limit": results_per_page,
-                    "facet.offset": results_current_page * results_per_page,
-                    "shards": shards,
-                    "rows": 0,
-                    "wt": "json",
-                    "json.nl": "map",  # return facets as a dict instead of a flat list
-                }
-
-                res = requests.get(solr_url, params=solr_query_params)
-
-                # Solr returns facets as a dict of dicts (see json.nl parameter)
-                views = res.json()["facet_counts"]["facet_fields"]
-                # iterate over the facetField dict and get the ids and views
-                for id_, views in views[facetField].items():
-                    data.append((id_, views))
-
-                # do a batch insert of values from the current "page" of results
-                sql = f"INSERT INTO {indexType}(id, views) VALUES %s ON CONFLICT(id) DO UPDATE SET views=excluded.views"
-                psycopg2.extras.execute_values(cursor, sql, data, template="(%s, %s)")
-                db.commit()
-
-                # clear all items from the list so we can populate it with the next batch
-                data.clear()
-
-                results_current_page += 1
-
-
-def index_downloads(indexType: str, facetField: str):
-    # get the total number of distinct facets for items with at least 1 download
-    solr_query_params = {
-        "q": f"type:0 AND {facetField}:/.{{36}}/",
-        "fq": "-isBot:true AND statistics_type:view AND bundleName:ORIGINAL",
-        "fl": facetField,
-        "facet": "true",
-        "facet.field": facetField,
-        "facet.mincount": 1,
-        "facet.limit": 1,
-        "facet.offset": 0,
-        "stats": "true",
-        "stats.field": facetField,
-        "stats.calcdistinct": "true",
-        "shards": shards,
-        "rows": 0,
-        "wt": "json",
-    }
+            cursor.execute(
+                """CREATE TEMPORARY TABLE shard_staging
+                      (id UUID, views INT, downloads INT) ON COMMIT DROP"""
+            )
+            cursor.copy_expert(
+                f"COPY shard_staging(id, {', '.join(metrics)}) FROM STDIN",
+                facet_reader,
+            )
 
-    solr_url = SOLR_SERVER + "/statistics/select"
+            # Replace the shard's old totals with one row per id and metric
+            cursor.execute(
+                "DELETE FROM shard_totals WHERE shard=%s AND scope=%s AND metric=ANY(%s)",
+                [shard, indexType, list(metrics)],
+            )
+            cursor.execute(
+                """INSERT INTO shard_totals(shard, scope, metric, id, count)
+                   SELECT %s, %s, counts.metric, id, counts.count FROM shard_staging
+                   CROSS JOIN LATERAL (VALUES ('views', views), ('downloads', downloads)) AS counts(metric, count)
+                   WHERE counts.metric=ANY(%s)""",
+                [shard, indexType, list(metrics)],
+            )
+            psycopg2.extras.execute_values(
+                cursor,
+                """INSERT INTO shard_versions(shard, scope, metric, version) VALUES %s
+                   ON CONFLICT(shard, scope, metric) DO UPDATE SET version=excluded.version""",
+                [(shard, indexType, metric, version) for metric in metrics],
+            )
 
-    res = requests.get(solr_url, params=solr_query_params)
+            # The scope's counts don't include the new totals until we recount
+            # everything, so make sure that happens even if this run fails.
+            cursor.execute(
+                "UPDATE watermarks SET reconciled=NULL WHERE scope=%s AND metric=ANY(%s)",
+                [indexType, list(metrics)],
+            )
 
-    try:
-        # get total number of distinct facets (countDistinct)
-        results_totalNumFacets = res.json()["stats"]["stats_fields"][facetField][
-            "countDistinct"
-        ]
-    except TypeError:
-        print(f"{indexType}: no downloads, exiting.")
+        db.commit()
 
-        exit(0)
+    log(
+        f"{indexType}: stored {' and '.join(metrics)} from {shard} for {facet_reader.total} ids"
+    )
 
-    results_per_page = 100
-    results_num_pages = math.ceil(results_totalNumFacets / results_per_page)
-    results_current_page = 0
+
+def index_facets(
+    context: RunContext,
+    indexType: str,
+    metrics: tuple,
+    facetField: str,
+    core: str,
+    since,
+):
+    """Fetch facet counts from Solr and copy them into the scope's staging
+    table.
+
+    :parameter context (RunContext): the run this is part of
+    :parameter indexType (str): type of indexing, for example "items"
+    :parameter metrics (tuple): metrics to count, for example ("views",)
+    :parameter facetField (str): Solr field to facet by, for example "id"
+    :parameter core (str): Solr core to query, for example "statistics"
+    :parameter since (datetime): watermark to count from (None for everything)
+    """
+    # Solr date format is: 2020-01-01T00:00:00Z. Note that the upper bound of
+    # the range is exclusive so that an event happening at exactly the water-
+    # mark is only ever counted once.
+    until = context.indexing_until.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    if since is None:
+        log(f"{indexType}: recounting all {' and '.join(metrics)}")
+
+        solr_date_string = f"[* TO {until}}}"
+    else:
+        since = since.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        log(f"{indexType}: counting {' and '.join(metrics)} since {since}")
+
+        solr_date_string = f"[{since} TO {until}}}"
+
+    facets = get_facets(
+        context, indexType, metrics, facetField, core, [f"time:{solr_date_string}"]
+    )
+    facet_reader = FacetReader(indexType, metrics, facets)
+
+    with DatabaseManager() as db:
+        with db.cursor() as cursor:
+            # Stream the facets into the staging table in a single COPY rather
+            # than inserting them in many small batches.
+            cursor.copy_expert(
+                f"COPY {indexType}_staging(id, {', '.join(metrics)}) FROM STDIN",
+                facet_reader,
+            )
+
+        db.commit()
+
+    log(
+        f"{indexType}: indexed {' and '.join(metrics)} from {core} for {facet_reader.total} ids"
+    )
+
+
+def lock_table(cursor, indexType: str):
+    """Lock a scope's table so we can swap it, waiting for the queries that are
+    reading it to finish.
+
+    Queries that arrive while we wait for the lock have to wait for us, so we
+    only wait for INDEXER_SWAP_LOCK_TIMEOUT seconds at a time and let them run
+    in between, up to INDEXER_SWAP_RETRIES times.
+
+    :parameter cursor: a database cursor in a transaction
+    :parameter indexType (str): the scope's table, for example "items"
+    :raises psycopg2.errors.LockNotAvailable: if we never got the lock
+    """
+    for attempt in range(INDEXER_SWAP_RETRIES + 1):
+        # Failing to get the lock aborts the transaction, so we only roll back
+        # to here rather than losing the new table.
+        cursor.execute("SAVEPOINT lock_table")
+        cursor.execute(
+            "SET LOCAL lock_timeout = %s", [int(INDEXER_SWAP_LOCK_TIMEOUT * 1000)]
+        )
+
+        try:
+            cursor.execute(f"LOCK TABLE {indexType} IN ACCESS EXCLUSIVE MODE")
+        except psycopg2.errors.LockNotAvailable:
+            cursor.execute("ROLLBACK TO SAVEPOINT lock_table")
+
+            if attempt == INDEXER_SWAP_RETRIES:
+                raise
+
+            log(f"{indexType}: table is busy, trying to swap it again")
+
+            time.sleep(INDEXER_SWAP_LOCK_TIMEOUT)
+        else:
+            cursor.execute("SET LOCAL lock_timeout TO DEFAULT")
+
+            return
+
+
+def merge_staging(
+    context: RunContext, indexType: str, metrics: tuple, since, reconciled
+):
+    """Merge the counts from a scope's staging table into the scope's table
+    and move the scope's watermark.
+
+    When counting incrementally the staging table contains the new events for
+    each id, which we add to the existing counts. For a full recount it has
+    the total counts, and any id that is not in the staging table any more is
+    set to zero.
+
+    For a full recount we build a complete new copy of the scope's table and
+    swap it in place of the old one, so readers always see a consistent snap-
+    shot and the table doesn't accumulate dead rows. Incremental counts, and
+    full recounts with INDEXER_TABLE_SWAP disabled, only update the rows whose
+    counts changed in place, which is much cheaper than rebuilding the table.
+
+    When we recount everything we also add the stored totals of the frozen
+    yearly shards, which are only ever counted in Solr when they change.
+
+    :parameter context (RunContext): the run this is part of
+    :parameter indexType (str): type of indexing, for example "items"
+    :parameter metrics (tuple): metrics that were counted
+    :parameter since (datetime): watermark we counted from (None for everything)
+    :parameter reconciled (datetime): time of the last full recount
+    """
+    # The staging table can have several rows for each id, for example one
+    # with the views and one with the downloads.
+    sums = ", ".join(f"SUM({metric}) AS {metric}" for metric in metrics)
+
+    swap = INDEXER_TABLE_SWAP and since is None
+
+    # When swapping tables the new table needs every column, including the
+    # ones for metrics we didn't count, which we copy from the old table.
+    if swap:
+        columns = tuple(metric_queries)
+    else:
+        columns = metrics
+
+    counts = []
+    for metric in columns:
+        if metric not in metrics:
+            counts.append(f"COALESCE(live.{metric}, 0)")
+        elif since is None:
+            counts.append(f"COALESCE(staging.{metric}, 0)")
+        else:
+            counts.append(f"COALESCE(live.{metric}, 0) + COALESCE(staging.{metric}, 0)")
+
+    # A full recount needs every id from both the old table and the staging
+    # table, otherwise only the ids we counted.
+    if since is None:
+        join = "FULL JOIN"
+    else:
+        join = "LEFT JOIN"
+
+    select = f"""WITH staging AS (SELECT id, {sums} FROM {indexType}_staging GROUP BY id)
+                 SELECT id, {', '.join(counts)} FROM staging {join} {indexType} AS live USING (id)"""
 
     with DatabaseManager() as db:
         with db.cursor() as cursor:
-            # create an empty list to store values for batch insertion
-            data = []
-
-            while results_current_page <= results_num_pages:
-                # "pages" are zero based, but one based is more human readable
-                print(
-                    f"{indexType}: indexing downloads (page {results_current_page + 1} of {results_num_pages + 1})"
-                )
-
-                solr_query_params = {
-                    "q": f"type:0 AND {facetField}:/.{{36}}/",
-                    "fq": "-isBot:true AND statistics_type:view AND bundleName:ORIGINAL",
-                    "fl": facetField,
-                    "facet": "true",
-                    "facet.field": facetField,
-                    "facet.mincount": 1,
-                    "facet.limit": results_per_page,
-                    "facet.offset": results_current_page * results_per_page,
-                    "shards": shards,
-                    "rows": 0,
-                    "wt": "json",
-                    "json.nl": "map",  # return facets as a dict instead of a flat list
-                }
-
-                res = requests.get(solr_url, params=solr_query_params)
-
-                # Solr returns facets as a dict of dicts (see json.nl parameter)
-                downloads = res.json()["facet_counts"]["facet_fields"]
-                # iterate over the facetField dict and get the item ids and downloads
-                for id_, downloads in downloads[facetField].items():
-                    data.append((id_, downloads))
-
-                # do a batch insert of values from the current "page" of results
-                sql = f"INSERT INTO {indexType}(id, downloads) VALUES %s ON CONFLICT(id) DO UPDATE SET downloads=excluded.downloads"
-                psycopg2.extras.execute_values(cursor, sql, data, template="(%s, %s)")
-                db.commit()
-
-                # clear all items from the list so we can populate it with the next batch
-                data.clear()
-
-                results_current_page += 1
-
-
-with DatabaseManager() as db:
+            if since is None:
+                # Add up the totals of each frozen shard. Totals of shards that
+                # don't exist any more are left out, and deleted below.
+                totals = ", ".join(
+                    f"SUM(count) FILTER (WHERE metric='{metric}')" for metric in metrics
+                )
+                cursor.execute(
+                    f"""INSERT INTO {indexType}_staging(id, {', '.join(metrics)})
+                        SELECT id, {totals} FROM shard_totals
+                        WHERE scope=%s AND metric=ANY(%s) AND shard=ANY(%s) GROUP BY id""",
+                    [indexType, list(metrics), list(context.frozen_shards)],
+                )
+
+                if context.frozen_shards:
+                    log(
+                        f"{indexType}: added totals from {len(context.frozen_shards)} frozen shards for {cursor.rowcount} ids"
+                    )
+
+                cursor.execute(
+                    "DELETE FROM shard_totals WHERE scope=%s AND NOT shard=ANY(%s)",
+                    [indexType, list(context.frozen_shards)],
+                )
+                cursor.execute(
+                    "DELETE FROM shard_versions WHERE scope=%s AND NOT shard=ANY(%s)",
+                    [indexType, list(context.frozen_shards)],
+                )
+
+            if swap:
+                # Build the new table and only add the primary key once it is
+                # full, which is much faster than updating the index as we go.
+                cursor.execute(f"DROP TABLE IF EXISTS {indexType}_new")
+                cursor.execute(
+                    f"""CREATE TABLE {indexType}_new
+                          (id UUID, views INT DEFAULT 0, downloads INT DEFAULT 0)"""
+                )
+                cursor.execute(
+                    f"INSERT INTO {indexType}_new(id, {', '.join(columns)}) {select}"
+                )
+
+                log(f"{indexType}: built new table with {cursor.rowcount} rows")
+
+                # We don't know which rows changed, so assume that some did
+                changed = True
+
+                cursor.execute(f"ALTER TABLE {indexType}_new ADD PRIMARY KEY (id)")
+                cursor.execute(f"ANALYZE {indexType}_new")
+
+                # Swap the new table in place of the old one. Renaming is
+                # instant, and readers will see either the old table or the
+                # new one once we commit, but we have to wait for the readers
+                # of the old table first.
+                lock_table(cursor, indexType)
+
+                cursor.execute(f"ALTER TABLE {indexType} RENAME TO {indexType}_old")
+                cursor.execute(f"ALTER TABLE {indexType}_new RENAME TO {indexType}")
+                cursor.execute(f"DROP TABLE {indexType}_old")
+                cursor.execute(
+                    f"ALTER INDEX {indexType}_new_pkey RENAME TO {indexType}_pkey"
+                )
+            else:
+                live_columns = ", ".join(f"live.{metric}" for metric in columns)
+                updates = ", ".join(f"{metric}=excluded.{metric}" for metric in columns)
+
+                # Only write the rows whose counts changed
+                cursor.execute(
+                    f"""INSERT INTO {indexType}(id, {', '.join(columns)}) {select}
+                        WHERE ({live_columns}) IS DISTINCT FROM ({', '.join(counts)})
+                        ON CONFLICT(id) DO UPDATE SET {updates}"""
+                )
+
+                log(f"{indexType}: updated {cursor.rowcount} rows")
+
+                changed = cursor.rowcount > 0
+
+            # Move the watermark in the same transaction as the counts so that
+            # a failed run is simply repeated from the old watermark next time.
+            psycopg2.extras.execute_values(
+                cursor,
+                """INSERT INTO watermarks(scope, metric, watermark, reconciled) VALUES %s
+                   ON CONFLICT(scope, metric) DO UPDATE SET watermark=excluded.watermark, reconciled=excluded.reconciled""",
+                [
+                    (indexType, metric, context.indexing_until, reconciled)
+                    for metric in metrics
+                ],
+            )
+
+            # Remember the version of each core's index that we counted from,
+            # and when we first saw it, so the next runs can skip this scope
+            # once they have counted everything up to then and none of the
+            # versions changed. We got the versions before counting, so an
+            # event committed during the run means the next run will not be
+            # skipped. If we only counted some of the scope's metrics the
+            # others may still be out of date.
+            if set(metrics) == set(metric_queries):
+                cursor.execute(
+                    "DELETE FROM core_versions WHERE scope=%s AND NOT core=ANY(%s)",
+                    [indexType, list(context.core_versions)],
+                )
+                psycopg2.extras.execute_values(
+                    cursor,
+                    """INSERT INTO core_versions(scope, core, version, seen) VALUES %s
+                       ON CONFLICT(scope, core) DO UPDATE SET version=excluded.version,
+                           seen=CASE WHEN core_versions.version=excluded.version
+                               THEN core_versions.seen ELSE excluded.seen END""",
+                    [
+                        (indexType, core, version, context.versions_read)
+                        for core, version in context.core_versions.items()
+                    ],
+                )
+
+            # Start a new generation of the scope's counts, which the API uses
+            # to know when they change, and store the number of rows so that
+            # the API doesn't have to count them. If nothing changed we keep
+            # the current generation and when it was indexed, as both are part
+            # of the ETags, the cached responses, and the snapshots' names.
+            if changed:
+                on_conflict = """DO UPDATE SET generation=generations.generation + 1,
+                                 indexed=excluded.indexed, total=excluded.total"""
+            else:
+                on_conflict = "DO NOTHING"
+
+            cursor.execute(
+                f"""INSERT INTO generations(scope, generation, indexed, total)
+                    VALUES (%s, 1, now(), (SELECT COUNT(*) FROM {indexType}))
+                    ON CONFLICT(scope) {on_conflict}""",
+                [indexType],
+            )
+
+            cursor.execute(f"TRUNCATE {indexType}_staging")
+
+        db.commit()
+
+
+def write_snapshot(indexType: str, export_format: str):
+    """Write a gzipped snapshot of a scope's table to SNAPSHOT_DIR, named after
+    the table's current generation, for example "items-42.ndjson.gz".
+
+    The snapshot is written to a temporary file in the same directory first and
+    renamed when it is complete, so nobody ever sees a partial snapshot.
+
+    :parameter indexType (str): the scope to snapshot, for example "items"
+    :parameter export_format (str): "ndjson" or "csv"
+    :returns: A tuple of the generation, the file name, its size, and its SHA-256
+    """
+    with DatabaseManager() as db:
+        # Read the generation and the rows from the same snapshot of the database
+        db.set_session(
+            isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ,
+            readonly=True,
+        )
+
+        with db.cursor() as cursor:
+            cursor.execute(
+                "SELECT generation FROM generations WHERE scope=%s", [indexType]
+            )
+            generation = cursor.fetchone()[0]
+
+        filename = f"{indexType}-{generation}.{export_format}.gz"
+        checksum = hashlib.sha256()
+        size = 0
+
+        with tempfile.NamedTemporaryFile(
+            dir=SNAPSHOT_DIR, prefix=f".{filename}.", delete=False
+        ) as f:
+            try:
+                with db.cursor(
+                    name=f"{indexType}_snapshot",
+                    cursor_factory=psycopg2.extensions.cursor,
+                ) as cursor:
+                    cursor.execute(
+                        f"SELECT id, views, downloads FROM {indexType} ORDER BY id"
+                    )
+
+                    for data in encode_export(cursor, export_format, compress=True):
+                        f.write(data)
+                        checksum.update(data)
+                        size += len(data)
+
+                f.flush()
+                os.fsync(f.fileno())
+            except BaseException:
+                os.unlink(f.name)
+                raise
+
+    # Temporary files are only readable by their owner, but the web server
+    # needs to be able to read the snapshot
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, os.path.join(SNAPSHOT_DIR, filename))
+
+    return generation, filename, size, checksum.hexdigest()
+
+
+def remove_old_snapshots(indexType: str, export_format: str):
+    """Remove the snapshots of a scope that are older than the last SNAPSHOT_KEEP
+    generations.
+
+    :parameter indexType (str): the scope, for example "items"
+    :parameter export_format (str): "ndjson" or "csv"
+    """
+    pattern = re.compile(rf"^{indexType}-([0-9]+)\.{export_format}\.gz$")
+
+    snapshots = sorted(
+        (
+            (int(match.group(1)), filename)
+            for filename in os.listdir(SNAPSHOT_DIR)
+            for match in [pattern.match(filename)]
+            if match
+        ),
+        reverse=True,
+    )
+
+    for generation, filename in snapshots[SNAPSHOT_KEEP:]:
+        os.remove(os.path.join(SNAPSHOT_DIR, filename))
+
+
+def write_snapshots(db, selected_scopes: list):
+    """Write snapshots of the selected scopes whose tables have changed since
+    their last snapshot, and record them in the snapshots table so the API can
+    advertise them.
+
+    :parameter db: a database connection in autocommit mode
+    :parameter selected_scopes (list): scopes to snapshot, for example ["items"]
+    """
     with db.cursor() as cursor:
-        # create table to store item views and downloads
+        for indexType in selected_scopes:
+            for export_format in ("ndjson", "csv"):
+                cursor.execute(
+                    """SELECT generations.generation FROM generations
+                       LEFT JOIN snapshots ON snapshots.scope=generations.scope AND snapshots.format=%s
+                       WHERE generations.scope=%s AND snapshots.generation IS DISTINCT FROM generations.generation""",
+                    [export_format, indexType],
+                )
+
+                # The scope hasn't been indexed yet, or the snapshot is current
+                if cursor.rowcount == 0:
+                    continue
+
+                log(f"{indexType}: writing {export_format} snapshot")
+
+                generation, filename, size, checksum = write_snapshot(
+                    indexType, export_format
+                )
+
+                cursor.execute(
+                    """INSERT INTO snapshots(scope, format, generation, filename, size, sha256, created)
+                       VALUES (%s, %s, %s, %s, %s, %s, now())
+                       ON CONFLICT(scope, format) DO UPDATE SET generation=excluded.generation,
+                           filename=excluded.filename, size=excluded.size, sha256=excluded.sha256,
+                           created=excluded.created""",
+                    [indexType, export_format, generation, filename, size, checksum],
+                )
+
+                remove_old_snapshots(indexType, export_format)
+
+
+# Index views and downloads for items, communities, and collections. Here the
+# first parameter is the type of indexing to perform, the second is the metrics
+# being indexed, and the last is the field to facet by in Solr's statistics to
+# get this information. Item views and downloads are faceted by different
+# fields, but communities and collections use the same field for both so we
+# can count them in a single request.
+jobs = [
+    ("items", ("views",), "id"),
+    ("items", ("downloads",), "owningItem"),
+    ("communities", ("views", "downloads"), "owningComm"),
+    ("collections", ("views", "downloads"), "owningColl"),
+]
+
+
+def create_tables(cursor):
+    """Create the tables that the indexer and the API need if they don't exist
+    yet.
+
+    :parameter cursor: a database cursor
+    """
+    for indexType in {job[0] for job in jobs}:
+        # create table to store the scope's views and downloads
         cursor.execute(
-            """CREATE TABLE IF NOT EXISTS items
+            f"""CREATE TABLE IF NOT EXISTS {indexType}
                   (id UUID PRIMARY KEY, views INT DEFAULT 0, downloads INT DEFAULT 0)"""
         )
-        # create table to store community views and downloads
+        # create an unlogged table to copy the counts from Solr into before
+        # they are merged into the scope's table. Unlogged tables are not
+        # written to the WAL, which makes them much faster to write to, and
+        # we don't care if they are lost in a crash.
         cursor.execute(
-            """CREATE TABLE IF NOT EXISTS communities
-                  (id UUID PRIMARY KEY, views INT DEFAULT 0, downloads INT DEFAULT 0)"""
+            f"""CREATE UNLOGGED TABLE IF NOT EXISTS {indexType}_staging
+                  (id UUID, views INT, downloads INT)"""
         )
-        # create table to store collection views and downloads
+
+    # create table to store the point in time up to which each scope and
+    # metric has been indexed, and when it was last fully recounted
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS watermarks
+              (scope TEXT, metric TEXT, watermark TIMESTAMPTZ, reconciled TIMESTAMPTZ, PRIMARY KEY(scope, metric))"""
+    )
+
+    # create table to store the generation of each scope's counts, which is
+    # incremented every time they are updated, and how many rows there are
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS generations
+              (scope TEXT PRIMARY KEY, generation BIGINT, indexed TIMESTAMPTZ, total BIGINT)"""
+    )
+
+    # create tables to store the totals of each frozen yearly shard, and
+    # the version of the shard's index that they were counted from
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS shard_totals
+              (shard TEXT, scope TEXT, metric TEXT, id UUID, count INT, PRIMARY KEY(shard, scope, metric, id))"""
+    )
+    # create table to store the version of each Solr core's index as of
+    # the last time each scope was indexed, and when we first saw it
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS core_versions
+              (scope TEXT, core TEXT, version BIGINT, seen TIMESTAMPTZ, PRIMARY KEY(scope, core))"""
+    )
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS shard_versions
+              (shard TEXT, scope TEXT, metric TEXT, version BIGINT, PRIMARY KEY(shard, scope, metric))"""
+    )
+
+    # create table to store the current snapshot file of each scope and format
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS snapshots
+              (scope TEXT, format TEXT, generation BIGINT, filename TEXT, size BIGINT, sha256 TEXT, created TIMESTAMPTZ, PRIMARY KEY(scope, format))"""
+    )
+
+
+def has_indexer_tables(cursor):
+    """Check if the tables that the indexer keeps track of its runs in exist.
+
+    :parameter cursor: a database cursor
+    :returns: True if create_tables() has created them
+    """
+    cursor.execute(
+        "SELECT to_regclass(table_name) IS NOT NULL FROM unnest(%s) AS table_name",
+        [["watermarks", "core_versions", "shard_versions"]],
+    )
+
+    return all(row[0] for row in cursor)
+
+
+def run(db, selected_scopes: list, selected_metrics: list, dry_run: bool = False):
+    """Index the views and downloads of the selected scopes once.
+
+    :parameter db: a database connection in autocommit mode
+    :parameter selected_scopes (list): scopes to index, for example ["items"]
+    :parameter selected_metrics (list): metrics to index, for example ["views"]
+    :parameter dry_run (bool): only log what would be indexed
+    :returns: A list of the jobs that failed
+    """
+    # Only run the jobs for the selected scopes and metrics
+    run_jobs = []
+    for indexType, metrics, facetField in jobs:
+        metrics = tuple(metric for metric in metrics if metric in selected_metrics)
+
+        if indexType in selected_scopes and metrics:
+            run_jobs.append((indexType, metrics, facetField))
+
+    # The metrics counted for each scope across all of its jobs
+    scopes = {}
+    for indexType, metrics, facetField in run_jobs:
+        scopes[indexType] = scopes.get(indexType, ()) + metrics
+
+    try:
+        core_versions = get_statistics_core_versions()
+    except requests.exceptions.RequestException as e:
+        # Without the list of cores we can't tell which shards were removed
+        log(f"indexer: failed to get the list of Solr statistics cores: {e}")
+
+        return ["cores"]
+
+    versions_read = datetime.datetime.now(datetime.timezone.utc)
+
+    if INDEXER_FACET_MODE == "paged":
+        log(
+            f"indexer: requesting {INDEXER_PAGE_SIZE} facets per page ({INDEXER_PAGE_SIZE_MIN} to {INDEXER_PAGE_SIZE_MAX}), targeting {INDEXER_PAGE_TARGET_SECONDS} seconds and {INDEXER_PAGE_TARGET_BYTES} bytes per page"
+        )
+
+    # Every scope is indexed up to the same point in time. We stay a little
+    # behind the current time because events only become visible in Solr after
+    # a commit, so events with a timestamp right before now may not be search-
+    # able yet.
+    indexing_until = datetime.datetime.now(datetime.timezone.utc).replace(
+        microsecond=0
+    ) - datetime.timedelta(seconds=INDEXER_WATERMARK_LAG)
+
+    context = RunContext(core_versions, versions_read, indexing_until)
+
+    with db.cursor() as cursor:
+        if dry_run and not has_indexer_tables(cursor):
+            # A dry run doesn't create the tables, and if they don't exist yet
+            # then nothing has been indexed yet either
+            log("indexer: would create the tables")
+
+            unchanged_scopes = []
+            windows = {indexType: (None, indexing_until) for indexType in scopes}
+            stale_shards = {
+                (indexType, metrics): list(context.frozen_shards)
+                for indexType, metrics, facetField in run_jobs
+            }
+        else:
+            unchanged_scopes = [
+                indexType
+                for indexType in scopes
+                if is_unchanged(context, cursor, indexType)
+            ]
+            windows = {
+                indexType: get_indexing_window(context, cursor, indexType, metrics)
+                for indexType, metrics in scopes.items()
+            }
+            stale_shards = {
+                (indexType, metrics): get_stale_shards(
+                    context, cursor, indexType, metrics
+                )
+                for indexType, metrics, facetField in run_jobs
+            }
+
+    for indexType in unchanged_scopes:
+        log(f"{indexType}: Solr has not changed since the last run, skipping")
+
+    if dry_run:
+        for indexType, metrics, facetField in run_jobs:
+            if indexType in unchanged_scopes:
+                continue
+
+            job = f"{indexType} {' and '.join(metrics)}"
+            since = windows[indexType][0]
+
+            for core in context.cores:
+                if since is None:
+                    log(f"{job}: would recount everything in {core}")
+                else:
+                    log(f"{job}: would count events in {core} since {since}")
+
+            for shard in stale_shards[(indexType, metrics)]:
+                log(f"{job}: would count everything in frozen shard {shard}")
+
+        return []
+
+    with db.cursor() as cursor:
+        for indexType in scopes:
+            # clear out anything left over from a previous run that failed
+            cursor.execute(f"TRUNCATE {indexType}_staging")
+
+    # The jobs spend most of their time waiting for Solr and PostgreSQL so we
+    # run them in a pool of threads. Each job opens its own database connection
+    # and a failing job doesn't stop the others. Once all of a scope's jobs are
+    # done we merge its counts, unless one of them failed.
+    failed_jobs = []
+    failed_scopes = set()
+    remaining_jobs = {indexType: 0 for indexType in scopes}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=INDEXER_WORKERS) as executor:
+        futures = {}
+        for indexType, metrics, facetField in run_jobs:
+            if indexType in unchanged_scopes:
+                continue
+
+            for core in context.cores:
+                future = executor.submit(
+                    index_facets,
+                    context,
+                    indexType,
+                    metrics,
+                    facetField,
+                    core,
+                    windows[indexType][0],
+                )
+                futures[future] = (
+                    indexType,
+                    f"{indexType} {' and '.join(metrics)} ({core})",
+                )
+                remaining_jobs[indexType] += 1
+
+            for shard in stale_shards[(indexType, metrics)]:
+                future = executor.submit(
+                    index_frozen_shard,
+                    context,
+                    indexType,
+                    metrics,
+                    facetField,
+                    shard,
+                    context.frozen_shards[shard],
+                )
+                futures[future] = (
+                    indexType,
+                    f"{indexType} {' and '.join(metrics)} ({shard})",
+                )
+                remaining_jobs[indexType] += 1
+
+        for finished, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            indexType, job = futures[future]
+
+            try:
+                future.result()
+            except Exception as e:
+                log(f"{job}: failed: {e}")
+
+                failed_jobs.append(job)
+                failed_scopes.add(indexType)
+
+            log(f"indexer: finished {finished} of {len(futures)} jobs ({job})")
+
+            remaining_jobs[indexType] -= 1
+            if remaining_jobs[indexType] > 0:
+                continue
+
+            if indexType in failed_scopes:
+                log(f"{indexType}: not updating because a job failed")
+
+                continue
+
+            try:
+                merge_staging(
+                    context, indexType, scopes[indexType], *windows[indexType]
+                )
+            except Exception as e:
+                log(f"{indexType}: failed to merge: {e}")
+
+                failed_jobs.append(indexType)
+
+    # Write snapshots of the scopes that were updated successfully, or that
+    # don't have a snapshot of their current counts yet
+    if SNAPSHOT_DIR:
+        try:
+            write_snapshots(
+                db,
+                [indexType for indexType in scopes if indexType not in failed_scopes],
+            )
+        except Exception as e:
+            log(f"indexer: failed to write snapshots: {e}")
+
+            failed_jobs.append("snapshots")
+
+    if failed_jobs:
+        log(f"indexer: failed jobs: {', '.join(failed_jobs)}")
+
+    return failed_jobs
+
+
+def run_locked(db, selected_scopes: list, selected_metrics: list):
+    """Index the selected scopes once, unless another indexer is running.
+
+    We hold a PostgreSQL advisory lock for the duration of the run so that two
+    indexers (for example the daemon and a run started by hand) can't index
+    the same database at the same time.
+
+    :parameter db: a database connection in autocommit mode
+    :parameter selected_scopes (list): scopes to index, for example ["items"]
+    :parameter selected_metrics (list): metrics to index, for example ["views"]
+    :returns: A list of the jobs that failed
+    """
+    with db.cursor() as cursor:
         cursor.execute(
-            """CREATE TABLE IF NOT EXISTS collections
-                  (id UUID PRIMARY KEY, views INT DEFAULT 0, downloads INT DEFAULT 0)"""
+            "SELECT pg_try_advisory_lock(hashtext('dspace-statistics-indexer'))"
         )
 
-    # commit the table creation before closing the database connection
-    db.commit()
+        if not cursor.fetchone()[0]:
+            log("indexer: another indexer is running, skipping this run")
 
-shards = get_statistics_shards()
+            return []
 
-# Index views and downloads for items, communities, and collections. Here the
-# first parameter is the type of indexing to perform, and the second parameter
-# is the field to facet by in Solr's statistics to get this information.
+        try:
+            return run(db, selected_scopes, selected_metrics)
+        finally:
+            cursor.execute(
+                "SELECT pg_advisory_unlock(hashtext('dspace-statistics-indexer'))"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Index views and downloads from DSpace's Solr statistics into PostgreSQL."
+    )
+    parser.add_argument(
+        "--scope",
+        action="append",
+        choices=["items", "communities", "collections"],
+        help="scope to index (can be given more than once, default: all)",
+    )
+    parser.add_argument(
+        "--metric",
+        action="append",
+        choices=list(metric_queries),
+        help="metric to index (can be given more than once, default: all)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only print what would be indexed",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and index every INDEXER_INTERVAL seconds",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=INDEXER_INTERVAL,
+        help=f"seconds between the start of each run in daemon mode (default: {INDEXER_INTERVAL})",
+    )
+    args = parser.parse_args()
+
+    selected_scopes = args.scope or ["items", "communities", "collections"]
+    selected_metrics = args.metric or list(metric_queries)
+
+    # We keep one connection for the whole run, each worker uses one for its
+    # job, and the scopes are merged on another while the other scopes' jobs
+    # are still running. With fewer than two connections nothing could be
+    # indexed at all.
+    if DATABASE_POOL_SIZE < 2:
+        log(
+            f"indexer: DATABASE_POOL_SIZE must be at least 2, and should be at least INDEXER_WORKERS + 2 ({INDEXER_WORKERS + 2})"
+        )
+
+        exit(1)
+
+    if DATABASE_POOL_SIZE < INDEXER_WORKERS + 2:
+        log(
+            f"indexer: DATABASE_POOL_SIZE should be at least INDEXER_WORKERS + 2 ({INDEXER_WORKERS + 2}), or the jobs and merges will have to wait for connections"
+        )
+
+    if not args.daemon:
+        with DatabaseManager() as db:
+            db.autocommit = True
+
+            # A dry run doesn't write anything, not even the tables
+            if args.dry_run:
+                failed_jobs = run(db, selected_scopes, selected_metrics, dry_run=True)
+            else:
+                with db.cursor() as cursor:
+                    create_tables(cursor)
+
+                failed_jobs = run_locked(db, selected_scopes, selected_metrics)
+
+        if failed_jobs:
+            exit(1)
+
+        return
+
+    # In daemon mode we keep the database connection and the connections to
+    # Solr open between runs, and start a run every interval. If a run takes
+    # longer than the interval the next one starts as soon as it is done.
+    while True:
+        try:
+            with DatabaseManager() as db:
+                db.autocommit = True
+
+                with db.cursor() as cursor:
+                    create_tables(cursor)
+
+                while True:
+                    started = time.monotonic()
+
+                    run_locked(db, selected_scopes, selected_metrics)
+
+                    time.sleep(max(args.interval - (time.monotonic() - started), 0))
+        except Exception as e:
+            # Most likely we lost the connection to the database or to Solr, so
+            # wait and then try again with a new connection.
+            log(f"indexer: run failed: {e}")
+
+            time.sleep(args.interval)
 
-index_views("items", "id")
-index_views("communities", "owningComm")
-index_views("collections", "owningColl")
 
-index_downloads("items", "owningItem")
-index_downloads("communities", "owningComm")
-index_downloads("collections", "owningColl")
+if __name__ == "__main__":
+    main()
 
 # vim: set sw=4 ts=4 expandtab:
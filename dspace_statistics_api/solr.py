@@ -0,0 +1,75 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .config import (
+    SOLR_CONNECT_TIMEOUT,
+    SOLR_POOL_SIZE,
+    SOLR_POST_THRESHOLD,
+    SOLR_READ_TIMEOUT,
+    SOLR_RETRIES,
+    SOLR_RETRY_BACKOFF,
+    SOLR_SERVER,
+)
+
+# Retry requests that fail because Solr is briefly unavailable (for example
+# while it is restarting) with an exponential backoff. Solr queries don't
+# change anything so it is safe to retry POST requests too. We don't retry
+# queries that time out because Solr is most likely still busy answering the
+# first one, and the caller may want to handle the timeout itself.
+retry = Retry(
+    total=SOLR_RETRIES,
+    read=False,
+    backoff_factor=SOLR_RETRY_BACKOFF,
+    status_forcelist=(502, 503, 504),
+    allowed_methods=None,
+    raise_on_status=False,
+)
+
+# A single session shared by everything in the process so that connections to
+# Solr are kept alive and reused instead of opening a new one for every query.
+# The session is safe to share between threads, each of which takes its own
+# connection from the pool.
+session = requests.Session()
+session.mount(
+    "http://",
+    HTTPAdapter(
+        pool_connections=SOLR_POOL_SIZE, pool_maxsize=SOLR_POOL_SIZE, max_retries=retry
+    ),
+)
+session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=SOLR_POOL_SIZE, pool_maxsize=SOLR_POOL_SIZE, max_retries=retry
+    ),
+)
+# Facet responses compress very well
+session.headers.update({"Accept-Encoding": "gzip"})
+
+
+def solr_request(path: str, params: dict, read_timeout: float = None, **kwargs):
+    """
+    Send a request to Solr using the shared session. Queries that are too long
+    to fit comfortably in a URL (for example a POST with many ids) are sent in
+    the body of a POST request instead.
+
+    :parameter path (str): path below SOLR_SERVER, for example "statistics/select"
+    :parameter params (dict): Solr query parameters
+    :parameter read_timeout (float): seconds to wait for Solr to answer (defaults
+        to SOLR_READ_TIMEOUT)
+    :returns: A requests Response
+    """
+    solr_url = f"{SOLR_SERVER}/{path}"
+    timeout = (SOLR_CONNECT_TIMEOUT, read_timeout or SOLR_READ_TIMEOUT)
+
+    if len(urlencode(params, doseq=True)) > SOLR_POST_THRESHOLD:
+        return session.post(solr_url, data=params, timeout=timeout, **kwargs)
+
+    return session.get(solr_url, params=params, timeout=timeout, **kwargs)
+
+
+# vim: set sw=4 ts=4 expandtab:
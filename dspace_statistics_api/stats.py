@@ -1,12 +1,122 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
-import requests
+import concurrent.futures
+import json
+import time
 
-from .config import SOLR_SERVER
-from .util import get_statistics_shards
+from .config import SOLR_QUERY_WORKERS, SOLR_SHARD_MODE, SOLR_SHARD_WORKERS
+from .solr import solr_request
+from .util import get_statistics_cores, get_statistics_shards, prune_statistics_cores
 
+# Thread pool used to query the statistics cores concurrently in "parallel"
+# shard mode. Threads are only started the first time we submit a query.
+shard_executor = concurrent.futures.ThreadPoolExecutor(max_workers=SOLR_SHARD_WORKERS)
 
-def get_views(solr_date_string: str, elements: list, facetField: str):
+# Thread pool used to send the views and downloads queries of POST requests
+# concurrently. This is separate from the shard pool because these queries
+# submit their own queries to the shard pool, and could otherwise end up
+# waiting for threads that are all busy waiting for them.
+query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=SOLR_QUERY_WORKERS)
+
+
+def wait_for_queries(futures: list, deadline: float):
+    """
+    Wait for queries submitted to the query_executor until the deadline. If a
+    query fails or the deadline passes the queries that haven't started yet are
+    cancelled. The ones that have started stop by themselves at the latest when
+    the deadline passes, because they use it as their timeout.
+
+    :parameter futures (list): the futures of the queries
+    :parameter deadline (float): time.monotonic() by which they must be done
+    :returns: A list of the results of the queries, in the same order
+    :raises concurrent.futures.TimeoutError: if the deadline passed
+    """
+    done, not_done = concurrent.futures.wait(
+        futures,
+        timeout=max(deadline - time.monotonic(), 0),
+        return_when=concurrent.futures.FIRST_EXCEPTION,
+    )
+
+    for future in not_done:
+        future.cancel()
+
+    # Raise the exception of the query that failed, if any
+    for future in futures:
+        if future in done and future.exception() is not None:
+            raise future.exception()
+
+    if not_done:
+        raise concurrent.futures.TimeoutError()
+
+    return [future.result() for future in futures]
+
+
+def query_statistics_cores(
+    solr_query_params: dict, solr_date_string: str, deadline: float = None
+):
+    """
+    Send a query to the Solr statistics core(s). In "distributed" shard mode we
+    send a single query to the statistics core and let Solr merge the results
+    from each yearly shard. In "parallel" mode we send the query to each core
+    directly and concurrently, and the caller has to add up the results. Only
+    the yearly shards that overlap with the date range are queried.
+
+    :parameter solr_query_params (dict): Solr query parameters
+    :parameter solr_date_string (str): Solr date string, for example "[* TO *]"
+    :parameter deadline (float): time.monotonic() by which Solr must answer
+    :returns: A list of Solr responses (one per core queried)
+    """
+    statistics_cores = prune_statistics_cores(get_statistics_cores(), solr_date_string)
+
+    def query_core(core: str, solr_query_params: dict):
+        read_timeout = None
+        if deadline is not None:
+            read_timeout = deadline - time.monotonic()
+
+            if read_timeout <= 0:
+                raise concurrent.futures.TimeoutError()
+
+        res = solr_request(f"{core}/select", solr_query_params, read_timeout)
+        res.raise_for_status()
+
+        return res.json()
+
+    if SOLR_SHARD_MODE != "parallel":
+        solr_query_params = {
+            **solr_query_params,
+            "shards": get_statistics_shards(statistics_cores),
+        }
+
+        return [query_core("statistics", solr_query_params)]
+
+    return list(
+        shard_executor.map(
+            query_core,
+            statistics_cores,
+            [solr_query_params] * len(statistics_cores),
+        )
+    )
+
+
+def terms_filter(field: str, elements: list):
+    """
+    Build a Solr filter query that matches the documents where a field has any
+    of a list of values. The terms query parser takes the values as they are,
+    so we don't have to escape them like in a boolean query, and Solr caches
+    the filter so repeated requests for the same elements are cheap.
+
+    See: https://solr.apache.org/guide/8_11/other-parsers.html#terms-query-parser
+
+    :parameter field (str): Solr field to filter by, for example "id"
+    :parameter elements (list): a list of IDs
+    :returns: A Solr filter query
+    """
+    return f"{{!terms f={field}}}{','.join(elements)}"
+
+
+def get_views(
+    solr_date_string: str, elements: list, facetField: str, deadline: float = None
+):
     """
     Get view statistics for a list of elements from Solr. Depending on the req-
     uest this could be items, communities, or collections.
@@ -14,61 +124,48 @@ def get_views(solr_date_string: str, elements: list, facetField: str):
     :parameter solr_date_string (str): Solr date string, for example "[* TO *]"
     :parameter elements (list): a list of IDs
     :parameter facetField (str): Solr field to facet by, for example "id"
+    :parameter deadline (float): time.monotonic() by which Solr must answer
     :returns: A dict of IDs and views
     """
-    shards = get_statistics_shards()
-
-    # Join the UUIDs with "OR" and escape the hyphens for Solr
-    solr_elements_string: str = " OR ".join(elements).replace("-", r"\-")
-
     solr_query_params = {
-        "q": f"{facetField}:({solr_elements_string})",
-        "fq": f"type:2 AND -isBot:true AND statistics_type:view AND time:{solr_date_string}",
+        "q": "*:*",
+        "fq": [
+            "type:2 AND -isBot:true AND statistics_type:view",
+            f"time:{solr_date_string}",
+            terms_filter(facetField, elements),
+        ],
         "fl": facetField,
         "facet": "true",
         "facet.field": facetField,
         "facet.mincount": 1,
-        "shards": shards,
+        "facet.limit": -1,
         "rows": 0,
         "wt": "json",
         "json.nl": "map",  # return facets as a dict instead of a flat list
     }
 
-    solr_url = SOLR_SERVER + "/statistics/select"
-    res = requests.get(solr_url, params=solr_query_params)
-
-    # Create an empty dict to store views
-    data = {}
-
-    # Solr returns facets as a dict of dicts (see the json.nl parameter)
-    views = res.json()["facet_counts"]["facet_fields"]
-    # iterate over the facetField dict and ids and views
-    for id_, views in views[facetField].items():
-        # For items we can rely on Solr returning facets for the *only* the ids
-        # in our query, but for communities and collections, the owningComm and
-        # owningColl fields are multi-value so Solr will return facets with the
-        # values in our query as well as *any others* that happen to be present
-        # in the field (which looks like Solr returning unrelated results until
-        # you realize that the field is multi-value and this is correct).
-        #
-        # To work around this I make sure that each id in the returned dict are
-        # present in the elements list POSTed by the user.
-        if id_ in elements:
-            data[id_] = views
-
-    # Check if any ids have missing stats so we can set them to 0
-    if len(data) < len(elements):
-        # List comprehension to get a list of ids (keys) in the data
-        data_ids = [k for k, v in data.items()]
-        for element_id in elements:
-            if element_id not in data_ids:
-                data[element_id] = 0
-                continue
+    # Start every element at 0 views so elements without any are included,
+    # and add up the views from each core
+    data = dict.fromkeys(elements, 0)
+
+    for response in query_statistics_cores(
+        solr_query_params, solr_date_string, deadline
+    ):
+        # Solr returns facets as a dict of dicts (see the json.nl parameter)
+        for id_, views in response["facet_counts"]["facet_fields"][facetField].items():
+            # If the field is multi-value Solr also returns facets for any other
+            # values in the field of the documents that matched (for example
+            # other communities that an item belongs to), so make sure that
+            # each id was requested by the user.
+            if id_ in data:
+                data[id_] += views
 
     return data
 
 
-def get_downloads(solr_date_string: str, elements: list, facetField: str):
+def get_downloads(
+    solr_date_string: str, elements: list, facetField: str, deadline: float = None
+):
     """
     Get download statistics for a list of items from Solr. Depending on the req-
     uest this could be items, communities, or collections.
@@ -76,51 +173,109 @@ def get_downloads(solr_date_string: str, elements: list, facetField: str):
     :parameter solr_date_string (str): Solr date string, for example "[* TO *]"
     :parameter elements (list): a list of IDs
     :parameter facetField (str): Solr field to facet by, for example "id"
+    :parameter deadline (float): time.monotonic() by which Solr must answer
     :returns: A dict of IDs and downloads
     """
-    shards = get_statistics_shards()
-
-    # Join the UUIDs with "OR" and escape the hyphens for Solr
-    solr_elements_string: str = " OR ".join(elements).replace("-", r"\-")
-
     solr_query_params = {
-        "q": f"{facetField}:({solr_elements_string})",
-        "fq": f"type:0 AND -isBot:true AND statistics_type:view AND bundleName:ORIGINAL AND time:{solr_date_string}",
+        "q": "*:*",
+        "fq": [
+            "type:0 AND -isBot:true AND statistics_type:view AND bundleName:ORIGINAL",
+            f"time:{solr_date_string}",
+            terms_filter(facetField, elements),
+        ],
         "fl": facetField,
         "facet": "true",
         "facet.field": facetField,
         "facet.mincount": 1,
-        "shards": shards,
+        "facet.limit": -1,
         "rows": 0,
         "wt": "json",
         "json.nl": "map",  # return facets as a dict instead of a flat list
     }
 
-    solr_url = SOLR_SERVER + "/statistics/select"
-    res = requests.get(solr_url, params=solr_query_params)
-
-    # Create an empty dict to store downloads
-    data = {}
-
-    # Solr returns facets as a dict of dicts (see the json.nl parameter)
-    downloads = res.json()["facet_counts"]["facet_fields"]
-    # Iterate over the facetField dict and get the ids and downloads
-    for id_, downloads in downloads[facetField].items():
-        # Make sure that each id in the returned dict are present in the
-        # elements list POSTed by the user.
-        if id_ in elements:
-            data[id_] = downloads
-
-    # Check if any elements have missing stats so we can set them to 0
-    if len(data) < len(elements):
-        # List comprehension to get a list of ids (keys) in the data
-        data_ids = [k for k, v in data.items()]
-        for element_id in elements:
-            if element_id not in data_ids:
-                data[element_id] = 0
-                continue
+    # Start every element at 0 downloads so elements without any are included,
+    # and add up the downloads from each core
+    data = dict.fromkeys(elements, 0)
+
+    for response in query_statistics_cores(
+        solr_query_params, solr_date_string, deadline
+    ):
+        # Solr returns facets as a dict of dicts (see the json.nl parameter)
+        for id_, downloads in response["facet_counts"]["facet_fields"][
+            facetField
+        ].items():
+            # Make sure that each id was requested by the user (see get_views()
+            # for why).
+            if id_ in data:
+                data[id_] += downloads
 
     return data
 
 
+def get_views_and_downloads(
+    solr_date_string: str, elements: list, facetField: str, deadline: float = None
+):
+    """
+    Get view and download statistics for a list of communities or collections
+    from Solr. Communities and collections use the same field for views and
+    downloads so we can get both in a single request using a JSON facet with
+    a sub-facet for each.
+
+    :parameter solr_date_string (str): Solr date string, for example "[* TO *]"
+    :parameter elements (list): a list of IDs
+    :parameter facetField (str): Solr field to facet by, for example "owningComm"
+    :parameter deadline (float): time.monotonic() by which Solr must answer
+    :returns: A tuple of a dict of IDs and views and a dict of IDs and downloads
+    """
+    # Drop duplicate ids, but keep them in the order they were requested
+    elements = list(dict.fromkeys(elements))
+
+    # The fields are multi-value, so a terms facet would return a bucket for
+    # every community or collection that the matching documents belong to,
+    # which can be thousands. Instead we use a query facet for each of the
+    # requested elements, named after its position in the list.
+    #
+    # See: https://solr.apache.org/guide/8_11/json-facet-api.html
+    json_facet = {
+        f"element{index}": {
+            "type": "query",
+            "q": f"{{!term f={facetField}}}{element}",
+            "facet": {
+                "views": {"type": "query", "q": "type:2"},
+                "downloads": {"type": "query", "q": "type:0 AND bundleName:ORIGINAL"},
+            },
+        }
+        for index, element in enumerate(elements)
+    }
+
+    solr_query_params = {
+        "q": "*:*",
+        "fq": [
+            "-isBot:true AND statistics_type:view AND (type:2 OR (type:0 AND bundleName:ORIGINAL))",
+            f"time:{solr_date_string}",
+            terms_filter(facetField, elements),
+        ],
+        "json.facet": json.dumps(json_facet),
+        "rows": 0,
+        "wt": "json",
+    }
+
+    # Start every element at 0 views and downloads and add up the views and
+    # downloads from each core
+    views = dict.fromkeys(elements, 0)
+    downloads = dict.fromkeys(elements, 0)
+
+    for response in query_statistics_cores(
+        solr_query_params, solr_date_string, deadline
+    ):
+        for index, element in enumerate(elements):
+            # Solr leaves out the sub-facets of elements without any matches
+            facet = response["facets"].get(f"element{index}", {})
+
+            views[element] += facet.get("views", {}).get("count", 0)
+            downloads[element] += facet.get("downloads", {}).get("count", 0)
+
+    return views, downloads
+
+
 # vim: set sw=4 ts=4 expandtab:
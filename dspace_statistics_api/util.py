@@ -2,58 +2,273 @@
 
 import datetime
 import json
+import logging
 import re
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
 
 import falcon
-import requests
 
-from .config import SOLR_SERVER
+from .config import (
+    CACHE_MAX_AGE,
+    LOOKUP_MAX_IDS,
+    POST_MAX_BODY,
+    POST_MAX_LIMIT,
+    RESPONSE_CACHE_SIZE,
+    SOLR_CORES_TTL,
+    SOLR_SERVER,
+)
+from .solr import solr_request
 
+logger = logging.getLogger(__name__)
 
-def get_statistics_shards():
+# Pattern to match the statistics cores, for example: statistics-2018
+statistics_core_pattern = re.compile("^statistics(-[0-9]{4})?$")
+
+
+def get_statistics_core_versions(index_info: bool = True):
     """Enumerate the cores in Solr to determine if statistics have been sharded into
     yearly shards by DSpace's stats-util or not (for example: statistics-2018).
 
+    Parameters:
+        index_info (bool):Whether to ask Solr for the details of each core's
+        index, which is much more expensive.
+
     Returns:
-        str:A list of Solr statistics shards separated by commas.
+        dict:The Solr statistics cores, starting with the default one, and the
+        version of their Lucene index (which changes whenever a core changes).
+
+    Raises:
+        requests.exceptions.RequestException:If Solr failed to answer.
     """
 
-    # Initialize an empty list for statistics core years
-    statistics_core_years = []
+    # Initialize a dict of statistics cores with the default one
+    statistics_cores = {"statistics": None}
 
     # URL for Solr status to check active cores
-    solr_query_params = {"action": "STATUS", "wt": "json"}
-    solr_url = SOLR_SERVER + "/admin/cores"
-    res = requests.get(solr_url, params=solr_query_params)
+    solr_query_params = {
+        "action": "STATUS",
+        "indexInfo": str(index_info).lower(),
+        "wt": "json",
+    }
+    res = solr_request("admin/cores", solr_query_params)
+
+    # Don't mistake a Solr that failed to answer for one without yearly shards
+    res.raise_for_status()
+
+    data = res.json()
+
+    # Iterate over active cores from Solr's STATUS response (cores are in the
+    # status array of this response).
+    for core in data["status"]:
+        if not statistics_core_pattern.match(core):
+            continue
+
+        # Add current core and its index version to the dict
+        statistics_cores[core] = data["status"][core].get("index", {}).get("version")
+
+    return statistics_cores
+
+
+class StatisticsCoreRegistry:
+    """Keep the list of Solr statistics cores so we don't have to ask Solr for
+    it on every request. The list is refreshed in the background once it is
+    older than SOLR_CORES_TTL seconds, and in the meantime (or if Solr fails to
+    answer) we keep using the last list we got.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.cores = None
+        self.updated = 0.0
+        self.refreshing = False
+
+    def refresh(self):
+        """Get the list of statistics cores from Solr right away. If Solr fails
+        to answer this raises and the last list we got is kept."""
+        cores = list(get_statistics_core_versions(index_info=False))
+
+        with self.lock:
+            self.cores = cores
+            self.updated = time.monotonic()
+
+        return cores
 
-    if res.status_code == requests.codes.ok:
-        data = res.json()
+    def background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning(f"Failed to refresh the list of Solr statistics cores: {e}")
+        finally:
+            with self.lock:
+                self.refreshing = False
 
-        # Iterate over active cores from Solr's STATUS response (cores are in
-        # the status array of this response).
-        for core in data["status"]:
-            # Pattern to match, for example: statistics-2018
-            pattern = re.compile("^statistics-[0-9]{4}$")
+    def get(self):
+        with self.lock:
+            cores = self.cores
 
-            if not pattern.match(core):
-                continue
+            # Only start one refresh at a time
+            if (
+                cores is not None
+                and time.monotonic() - self.updated > self.ttl
+                and not self.refreshing
+            ):
+                self.refreshing = True
+                threading.Thread(target=self.background_refresh, daemon=True).start()
+
+        # We have to wait for Solr the first time
+        if cores is None:
+            cores = self.refresh()
+
+        return cores
+
+
+statistics_core_registry = StatisticsCoreRegistry(SOLR_CORES_TTL)
+
+
+def get_statistics_cores():
+    """Enumerate the cores in Solr to determine if statistics have been sharded into
+    yearly shards by DSpace's stats-util or not (for example: statistics-2018).
+
+    Returns:
+        list:A list of Solr statistics cores, starting with the default one.
+    """
+
+    return statistics_core_registry.get()
+
+
+def refresh_statistics_cores():
+    """Get the list of Solr statistics cores from Solr again, for example after
+    stats-util has created a new yearly shard.
+
+    Returns:
+        list:A list of Solr statistics cores, starting with the default one.
+    """
+
+    return statistics_core_registry.refresh()
+
+
+class ResponseCache:
+    """Keep the most recently used responses of the GET endpoints in memory,
+    already serialized to JSON, along with the generation of the table they
+    were read from. An entry is only used while the generation hasn't changed,
+    that is, until the indexer updates the table again.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, generation):
+        """Get the serialized response for a key, or None if it isn't in the
+        cache or it was read from an older generation of the table."""
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] != generation:
+                self.misses += 1
+
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[1]
+
+    def put(self, key: tuple, generation, body: bytes):
+        # We can't tell when responses for scopes that haven't been indexed
+        # since the generations table was added go stale.
+        if self.size <= 0 or generation is None:
+            return
+
+        with self.lock:
+            self.entries[key] = (generation, body)
+            self.entries.move_to_end(key)
+
+            # Evict the least recently used entries
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "size": self.size,
+            }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+
+def prune_statistics_cores(statistics_cores: list, solr_date_string: str):
+    """Leave out the yearly statistics shards that can't contain any events in
+    a date range. The default statistics core is always kept.
+
+    Parameters:
+        statistics_cores (list):A list of Solr statistics cores.
+        solr_date_string (str):A Solr date range, for example "[* TO *]".
+
+    Returns:
+        list:The Solr statistics cores that overlap with the date range.
+    """
+
+    date_from, date_to = solr_date_string.strip("[]{}").split(" TO ")
+
+    # stats-util splits the events into yearly shards using the server's local
+    # time, so an event on the first or last day of a year may be in the shard
+    # of the year before or after in UTC. Querying an extra shard is harmless
+    # as the query still filters by time. We work with the years rather than
+    # adding or subtracting a day because the dates may be at the very start
+    # or end of what datetime can represent.
+    year_from = 0
+    if date_from != "*":
+        date = datetime.datetime.strptime(date_from, "%Y-%m-%dT%H:%M:%SZ")
+        year_from = date.year - 1 if (date.month, date.day) == (1, 1) else date.year
+
+    year_to = 9999
+    if date_to != "*":
+        date = datetime.datetime.strptime(date_to, "%Y-%m-%dT%H:%M:%SZ")
+        year_to = date.year + 1 if (date.month, date.day) == (12, 31) else date.year
+
+    return [
+        core
+        for core in statistics_cores
+        if core == "statistics" or year_from <= int(core[-4:]) <= year_to
+    ]
+
+
+def get_statistics_shards(statistics_cores: list = None):
+    """Build the list of Solr statistics shards to pass to a distributed query.
+
+    Parameters:
+        statistics_cores (list):The Solr statistics cores to query (defaults to
+        all of them).
+
+    Returns:
+        str:A list of Solr statistics shards separated by commas.
+    """
 
-            # Append current core to list
-            statistics_core_years.append(core)
+    if statistics_cores is None:
+        statistics_cores = get_statistics_cores()
 
     # Initialize a string to hold our shards (may end up being empty if the Solr
     # core has not been processed by stats-util).
     shards = str()
 
-    if len(statistics_core_years) > 0:
-        # Begin building a string of shards starting with the default one
-        shards = f"{SOLR_SERVER}/statistics"
-
-        for core in statistics_core_years:
-            # Create a comma-separated list of shards to pass to our Solr query
-            #
-            # See: https://wiki.apache.org/solr/DistributedSearch
-            shards += f",{SOLR_SERVER}/{core}"
+    if len(statistics_cores) > 1:
+        # Create a comma-separated list of shards to pass to our Solr query
+        #
+        # See: https://wiki.apache.org/solr/DistributedSearch
+        shards = ",".join(f"{SOLR_SERVER}/{core}" for core in statistics_cores)
 
     # Return the string of shards, which may actually be empty. Solr doesn't
     # seem to mind if the shards query parameter is empty and I haven't seen
@@ -75,6 +290,144 @@ def is_valid_date(date):
         )
 
 
+def is_not_modified(req, resp, scope: str, generation) -> bool:
+    """Set the ETag, Last-Modified, and Cache-Control headers of a response to
+    a GET request based on the generation of the scope's table, and check if
+    the client's copy of the response is still current.
+
+    If it is, the response is turned into an empty "304 Not Modified" and the
+    caller doesn't need to query the statistics at all.
+
+    Parameters:
+        scope (str): The scope's table, for example "items"
+        generation (tuple): The generation of the table and when it was indexed,
+        as returned by get_generation(), or None if it is unknown.
+
+    Returns:
+        bool:Whether the client's copy of the response is still current.
+    """
+
+    # We can't tell when the statistics changed if the scope hasn't been
+    # indexed since the generations table was added.
+    if generation is None:
+        return False
+
+    generation, indexed = generation
+
+    # Last-Modified has a resolution of one second and is always in UTC
+    last_modified = indexed.astimezone(datetime.timezone.utc).replace(
+        tzinfo=None, microsecond=0
+    )
+
+    # Include the time in the ETag so that it changes even if the generations
+    # table is dropped and the generation starts from 1 again.
+    etag = f"{scope}-{generation}-{int(indexed.timestamp())}"
+
+    resp.etag = etag
+    resp.last_modified = last_modified
+    resp.cache_control = ["public", f"max-age={CACHE_MAX_AGE}"]
+
+    # If-Modified-Since is ignored when the client sends If-None-Match. Note
+    # that Falcon's ETags compare equal regardless of whether they are weak.
+    if req.if_none_match is not None:
+        not_modified = etag in req.if_none_match
+    elif req.if_modified_since is not None:
+        not_modified = last_modified <= req.if_modified_since
+    else:
+        not_modified = False
+
+    if not_modified:
+        resp.status = falcon.HTTP_304
+
+    return not_modified
+
+
+def encode_export(cursor, export_format: str, compress: bool):
+    """Encode the views and downloads of a scope's elements as NDJSON or CSV, a
+    batch of rows at a time, so the memory we use doesn't depend on the number
+    of rows. Used for both the export endpoints and the indexer's snapshots.
+
+    Parameters:
+        cursor: A (named) database cursor on the id, views, and downloads of
+        each element, or anything else with a fetchmany() that returns them.
+        export_format (str): "ndjson" or "csv".
+        compress (bool): Whether to compress the output with gzip.
+
+    Yields:
+        bytes:The next chunk of the output.
+    """
+    batch_size = 10000
+
+    # wbits=31 makes zlib write a gzip header and trailer
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def encode(data: bytes):
+        return compressor.compress(data) if compressor else data
+
+    if export_format == "csv":
+        yield encode(b"id,views,downloads\n")
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+
+        if export_format == "csv":
+            lines = [f"{id_},{views},{downloads}\n" for id_, views, downloads in rows]
+        else:
+            # ids are UUIDs and the counts integers, so there is nothing to
+            # escape and we don't need the json module
+            lines = [
+                f'{{"id": "{id_}", "views": {views}, "downloads": {downloads}}}\n'
+                for id_, views, downloads in rows
+            ]
+
+        data = encode("".join(lines).encode())
+
+        # The compressor buffers small inputs, so it may not return any output
+        # yet
+        if data:
+            yield data
+
+    if compressor:
+        yield compressor.flush()
+
+
+def read_json_body(req):
+    """Read and parse the JSON body of a POST request.
+
+    Parameters:
+        req: The Falcon request.
+
+    Returns:
+        The parsed body, which may be any JSON value.
+
+    Raises:
+        falcon.HTTPPayloadTooLarge:If the body is larger than POST_MAX_BODY.
+        falcon.HTTPBadRequest:If the body is empty or not valid JSON.
+    """
+
+    # Only attempt to read the POSTed request if its length is not 0 (or
+    # rather, in the Python sense, if length is not a False-y value). Refuse
+    # bodies that are too large before reading any of them.
+    if req.content_length and req.content_length > POST_MAX_BODY:
+        raise falcon.HTTPPayloadTooLarge(
+            title="Request body too large",
+            description=f"Request body must not be larger than {POST_MAX_BODY} bytes.",
+        )
+    elif req.content_length:
+        try:
+            return json.loads(req.bounded_stream.read())
+        except ValueError:
+            raise falcon.HTTPBadRequest(
+                title="Invalid request", description="Request body is not valid JSON."
+            )
+    else:
+        raise falcon.HTTPBadRequest(
+            title="Invalid request", description="Request body is empty."
+        )
+
+
 def validate_post_parameters(req, resp, resource, params):
     """Check the POSTed request parameters for the `/items`, `/communities` and
     `/collections` endpoints.
@@ -82,13 +435,11 @@ def validate_post_parameters(req, resp, resource, params):
     Meant to be used as a `before` hook.
     """
 
-    # Only attempt to read the POSTed request if its length is not 0 (or
-    # rather, in the Python sense, if length is not a False-y value).
-    if req.content_length:
-        doc = json.load(req.bounded_stream)
-    else:
+    doc = read_json_body(req)
+
+    if not isinstance(doc, dict):
         raise falcon.HTTPBadRequest(
-            title="Invalid request", description="Request body is empty."
+            title="Invalid request", description="Request body must be a JSON object."
         )
 
     # Parse date parameters from request body (will raise an HTTPBadRequest
@@ -105,12 +456,12 @@ def validate_post_parameters(req, resp, resource, params):
 
     # Parse the limit parameter from the POST request body
     if "limit" in doc:
-        if isinstance(doc["limit"], int) and 0 < doc["limit"] <= 100:
+        if isinstance(doc["limit"], int) and 0 < doc["limit"] <= POST_MAX_LIMIT:
             req.context.limit = doc["limit"]
         else:
             raise falcon.HTTPBadRequest(
                 title="Invalid parameter",
-                description='The "limit" parameter is invalid. The value must be an integer between 1 and 100.',
+                description=f'The "limit" parameter is invalid. The value must be an integer between 1 and {POST_MAX_LIMIT}.',
             )
     else:
         req.context.limit = 100
@@ -132,6 +483,7 @@ def validate_post_parameters(req, resp, resource, params):
         if (
             isinstance(doc[req.context.statistics_scope], list)
             and len(doc[req.context.statistics_scope]) > 0
+            and all(isinstance(id_, str) for id_ in doc[req.context.statistics_scope])
         ):
             req.context.elements = doc[req.context.statistics_scope]
         else:
@@ -143,9 +495,39 @@ def validate_post_parameters(req, resp, resource, params):
         req.context.elements = []
 
 
+def validate_lookup_parameters(req, resp, resource, params):
+    """Check the POSTed request parameters for the `/items/lookup`,
+    `/communities/lookup` and `/collections/lookup` endpoints.
+
+    Meant to be used as a `before` hook.
+    """
+
+    doc = read_json_body(req)
+
+    invalid = falcon.HTTPBadRequest(
+        title="Invalid parameter",
+        description=f'The "{req.context.statistics_scope}" parameter is invalid. The value must be a list of between 1 and {LOOKUP_MAX_IDS} UUIDs.',
+    )
+
+    elements = doc.get(req.context.statistics_scope) if isinstance(doc, dict) else None
+
+    if (
+        not isinstance(elements, list)
+        or not 0 < len(elements) <= LOOKUP_MAX_IDS
+        or not all(isinstance(element, str) for element in elements)
+    ):
+        raise invalid
+
+    try:
+        # Drop duplicate ids, but keep them in the order they were requested
+        req.context.elements = list(dict.fromkeys(uuid.UUID(x) for x in elements))
+    except ValueError:
+        raise invalid
+
+
 def set_statistics_scope(req, resp, resource, params):
     """Set the statistics scope (item, collection, or community) of the request
-    as well as the appropriate database (for GET requests) and Solr facet fields
+    as well as the appropriate database (for GET requests and lookups) and Solr facet fields
     (for POST requests).
 
     Meant to be used as a `before` hook.
@@ -162,17 +544,17 @@ def set_statistics_scope(req, resp, resource, params):
     )[0]
 
     # Set the correct database based on the statistics_scope. The database is
-    # used for all GET requests where statistics are returned directly from the
-    # database. In this case we can return early.
+    # used for all GET requests and lookups where statistics are returned
+    # directly from the database.
+    if re.findall(r"^(item|items)$", req.context.statistics_scope):
+        req.context.database = "items"
+    elif re.findall(r"^(community|communities)$", req.context.statistics_scope):
+        req.context.database = "communities"
+    elif re.findall(r"^(collection|collections)$", req.context.statistics_scope):
+        req.context.database = "collections"
+
+    # GET requests only need the scope and the database so we can return now
     if req.method == "GET":
-        if re.findall(r"^(item|items)$", req.context.statistics_scope):
-            req.context.database = "items"
-        elif re.findall(r"^(community|communities)$", req.context.statistics_scope):
-            req.context.database = "communities"
-        elif re.findall(r"^(collection|collections)$", req.context.statistics_scope):
-            req.context.database = "collections"
-
-        # GET requests only need the scope and the database so we can return now
         return
 
     # If the current request is for a plural items, communities, or collections
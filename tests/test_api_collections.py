@@ -62,6 +62,27 @@ def test_get_collections_invalid_page(client):
     assert response.status_code == 400
 
 
+def test_post_collections_lookup(client):
+    """Test looking up an existing and a non-existing collection."""
+
+    request_body = {
+        "collections": [
+            "8ea4b611-1f59-4d4e-b78d-a9921a72cfe7",
+            "508abe0a-689f-402e-885d-2f6b02e7a39c",
+        ]
+    }
+
+    response = client.simulate_post("/collections/lookup", json=request_body)
+    response_doc = json.loads(response.text)
+
+    assert response.status_code == 200
+    assert len(response_doc["statistics"]) == 1
+    assert response_doc["statistics"][0]["id"] == "8ea4b611-1f59-4d4e-b78d-a9921a72cfe7"
+    assert isinstance(response_doc["statistics"][0]["views"], int)
+    assert isinstance(response_doc["statistics"][0]["downloads"], int)
+    assert response_doc["missing"] == ["508abe0a-689f-402e-885d-2f6b02e7a39c"]
+
+
 @pytest.mark.xfail
 def test_post_collections_valid_dateFrom(client):
     """Test POSTing a request to /collections with a valid dateFrom parameter in the request body."""
@@ -108,13 +129,10 @@ def test_post_collections_valid_dateFrom_mocked(client):
     }
 
     with patch(
-        "dspace_statistics_api.app.get_views", return_value=get_views_return_value
+        "dspace_statistics_api.app.get_views_and_downloads",
+        return_value=(get_views_return_value, get_downloads_return_value),
     ):
-        with patch(
-            "dspace_statistics_api.app.get_downloads",
-            return_value=get_downloads_return_value,
-        ):
-            response = client.simulate_post("/collections", json=request_body)
+        response = client.simulate_post("/collections", json=request_body)
 
     assert response.status_code == 200
     assert response.json["limit"] == 100
@@ -189,13 +207,10 @@ def test_post_collections_valid_dateTo_mocked(client):
     }
 
     with patch(
-        "dspace_statistics_api.app.get_views", return_value=get_views_return_value
+        "dspace_statistics_api.app.get_views_and_downloads",
+        return_value=(get_views_return_value, get_downloads_return_value),
     ):
-        with patch(
-            "dspace_statistics_api.app.get_downloads",
-            return_value=get_downloads_return_value,
-        ):
-            response = client.simulate_post("/collections", json=request_body)
+        response = client.simulate_post("/collections", json=request_body)
 
     assert response.status_code == 200
     assert response.json["limit"] == 100
@@ -262,13 +277,10 @@ def test_post_collections_valid_limit_mocked(client):
     get_downloads_return_value = {"8ea4b611-1f59-4d4e-b78d-a9921a72cfe7": 575}
 
     with patch(
-        "dspace_statistics_api.app.get_views", return_value=get_views_return_value
+        "dspace_statistics_api.app.get_views_and_downloads",
+        return_value=(get_views_return_value, get_downloads_return_value),
     ):
-        with patch(
-            "dspace_statistics_api.app.get_downloads",
-            return_value=get_downloads_return_value,
-        ):
-            response = client.simulate_post("/collections", json=request_body)
+        response = client.simulate_post("/collections", json=request_body)
 
     assert response.status_code == 200
     assert response.json["limit"] == 1
@@ -341,13 +353,10 @@ def test_post_collections_valid_page_mocked(client):
     }
 
     with patch(
-        "dspace_statistics_api.app.get_views", return_value=get_views_return_value
+        "dspace_statistics_api.app.get_views_and_downloads",
+        return_value=(get_views_return_value, get_downloads_return_value),
     ):
-        with patch(
-            "dspace_statistics_api.app.get_downloads",
-            return_value=get_downloads_return_value,
-        ):
-            response = client.simulate_post("/collections", json=request_body)
+        response = client.simulate_post("/collections", json=request_body)
 
     assert response.status_code == 200
     assert response.json["limit"] == 100
@@ -1,7 +1,7 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 import json
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import pytest
 from falcon import testing
@@ -62,6 +62,27 @@ def test_get_communities_invalid_page(client):
     assert response.status_code == 400
 
 
+def test_post_communities_lookup(client):
+    """Test looking up an existing and a non-existing community."""
+
+    request_body = {
+        "communities": [
+            "bde7139c-d321-46bb-aef6-ae70799e5edb",
+            "dec6bfc6-efeb-4f74-8436-79fa80bb5c21",
+        ]
+    }
+
+    response = client.simulate_post("/communities/lookup", json=request_body)
+    response_doc = json.loads(response.text)
+
+    assert response.status_code == 200
+    assert len(response_doc["statistics"]) == 1
+    assert response_doc["statistics"][0]["id"] == "bde7139c-d321-46bb-aef6-ae70799e5edb"
+    assert isinstance(response_doc["statistics"][0]["views"], int)
+    assert isinstance(response_doc["statistics"][0]["downloads"], int)
+    assert response_doc["missing"] == ["dec6bfc6-efeb-4f74-8436-79fa80bb5c21"]
+
+
 @pytest.mark.xfail
 def test_post_communities_valid_dateFrom(client):
     """Test POSTing a request to /communities with a valid dateFrom parameter in the request body."""
@@ -108,13 +129,10 @@ def test_post_communities_valid_dateFrom_mocked(client):
     }
 
     with patch(
-        "dspace_statistics_api.app.get_views", return_value=get_views_return_value
+        "dspace_statistics_api.app.get_views_and_downloads",
+        return_value=(get_views_return_value, get_downloads_return_value),
     ):
-        with patch(
-            "dspace_statistics_api.app.get_downloads",
-            return_value=get_downloads_return_value,
-        ):
-            response = client.simulate_post("/communities", json=request_body)
+        response = client.simulate_post("/communities", json=request_body)
 
     assert response.status_code == 200
     assert response.json["limit"] == 100
@@ -127,6 +145,51 @@ def test_post_communities_valid_dateFrom_mocked(client):
     assert isinstance(response.json["statistics"][1]["downloads"], int)
 
 
+def test_post_communities_query_facets(client):
+    """Mock test POSTing a request to /communities to make sure that Solr only counts the requested communities."""
+
+    request_body = {
+        "communities": [
+            "bde7139c-d321-46bb-aef6-ae70799e5edb",
+            "2a920a61-b08a-4642-8e5d-2639c6702b1f",
+        ],
+    }
+
+    solr_response = MagicMock()
+    solr_response.json.return_value = {
+        "facets": {
+            "count": 1000,
+            "element0": {
+                "count": 1000,
+                "views": {"count": 800},
+                "downloads": {"count": 200},
+            },
+            "element1": {"count": 0},
+        }
+    }
+
+    with patch(
+        "dspace_statistics_api.stats.get_statistics_cores", return_value=["statistics"]
+    ):
+        with patch(
+            "dspace_statistics_api.stats.solr_request", return_value=solr_response
+        ) as solr_request:
+            response = client.simulate_post("/communities", json=request_body)
+
+    assert response.status_code == 200
+    assert response.json["statistics"] == [
+        {"id": "bde7139c-d321-46bb-aef6-ae70799e5edb", "views": 800, "downloads": 200},
+        {"id": "2a920a61-b08a-4642-8e5d-2639c6702b1f", "views": 0, "downloads": 0},
+    ]
+
+    json_facet = json.loads(solr_request.call_args.args[1]["json.facet"])
+
+    assert (
+        json_facet["element1"]["q"]
+        == "{!term f=owningComm}2a920a61-b08a-4642-8e5d-2639c6702b1f"
+    )
+
+
 def test_post_communities_invalid_dateFrom(client):
     """Test POSTing a request to /communities with an invalid dateFrom parameter in the request body."""
 
@@ -189,13 +252,10 @@ def test_post_communities_valid_dateTo_mocked(client):
     }
 
     with patch(
-        "dspace_statistics_api.app.get_views", return_value=get_views_return_value
+        "dspace_statistics_api.app.get_views_and_downloads",
+        return_value=(get_views_return_value, get_downloads_return_value),
     ):
-        with patch(
-            "dspace_statistics_api.app.get_downloads",
-            return_value=get_downloads_return_value,
-        ):
-            response = client.simulate_post("/communities", json=request_body)
+        response = client.simulate_post("/communities", json=request_body)
 
     assert response.status_code == 200
     assert response.json["limit"] == 100
@@ -262,13 +322,10 @@ def test_post_communities_valid_limit_mocked(client):
     get_downloads_return_value = {"bde7139c-d321-46bb-aef6-ae70799e5edb": 309}
 
     with patch(
-        "dspace_statistics_api.app.get_views", return_value=get_views_return_value
+        "dspace_statistics_api.app.get_views_and_downloads",
+        return_value=(get_views_return_value, get_downloads_return_value),
     ):
-        with patch(
-            "dspace_statistics_api.app.get_downloads",
-            return_value=get_downloads_return_value,
-        ):
-            response = client.simulate_post("/communities", json=request_body)
+        response = client.simulate_post("/communities", json=request_body)
 
     assert response.status_code == 200
     assert response.json["limit"] == 1
@@ -341,13 +398,10 @@ def test_post_communities_valid_page_mocked(client):
     }
 
     with patch(
-        "dspace_statistics_api.app.get_views", return_value=get_views_return_value
+        "dspace_statistics_api.app.get_views_and_downloads",
+        return_value=(get_views_return_value, get_downloads_return_value),
     ):
-        with patch(
-            "dspace_statistics_api.app.get_downloads",
-            return_value=get_downloads_return_value,
-        ):
-            response = client.simulate_post("/communities", json=request_body)
+        response = client.simulate_post("/communities", json=request_body)
 
     assert response.status_code == 200
     assert response.json["limit"] == 100
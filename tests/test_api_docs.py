@@ -1,5 +1,8 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
+import datetime
+from unittest.mock import patch
+
 import pytest
 from falcon import testing
 
@@ -45,6 +48,33 @@ def test_get_status(client):
 
     assert isinstance(response.content, bytes)
     assert response.status_code == 200
+    assert isinstance(response.json["responseCache"]["hits"], int)
+    assert isinstance(response.json["responseCache"]["misses"], int)
+
+
+@patch(
+    "dspace_statistics_api.app.get_snapshots",
+    return_value=[
+        (
+            "items",
+            "ndjson",
+            7,
+            datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+            "items-7.ndjson.gz",
+            1337,
+            "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855",
+        )
+    ],
+)
+def test_get_snapshots(mock_get_snapshots, client):
+    """Test requesting the list of snapshots."""
+
+    response = client.simulate_get("/snapshots")
+
+    assert response.status_code == 200
+    assert response.json["snapshots"][0]["url"].endswith("/items-7.ndjson.gz")
+    assert response.json["snapshots"][0]["size"] == 1337
+    assert response.json["snapshots"][0]["created"] == "2020-01-01T00:00:00+00:00"
 
 
 # vim: set sw=4 ts=4 expandtab:
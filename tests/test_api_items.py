@@ -1,12 +1,19 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
+import csv
+import datetime
+import gzip
 import json
-from unittest.mock import patch
+import time
+import uuid
+from unittest.mock import MagicMock, patch
 
 import pytest
+import requests
 from falcon import testing
 
-from dspace_statistics_api.app import app
+from dspace_statistics_api.app import ExportReader, app
+from dspace_statistics_api.database import ConnectionPool
 
 
 @pytest.fixture
@@ -46,6 +53,17 @@ def test_get_items(client):
     assert response.status_code == 200
 
 
+def test_get_items_pool_exhausted(client):
+    """Test requesting items when all database connections are in use."""
+
+    with patch("dspace_statistics_api.database.DATABASE_POOL_TIMEOUT", 0), patch(
+        "dspace_statistics_api.database.get_pool", return_value=ConnectionPool("", 0)
+    ):
+        response = client.simulate_get("/items")
+
+    assert response.status_code == 503
+
+
 def test_get_items_invalid_limit(client):
     """Test requesting 100 items with an invalid limit parameter."""
 
@@ -62,6 +80,228 @@ def test_get_items_invalid_page(client):
     assert response.status_code == 400
 
 
+def test_get_items_after(client):
+    """Test requesting items after a cursor."""
+
+    response = client.simulate_get("/items", query_string="limit=2")
+
+    assert response.status_code == 200
+    assert isinstance(response.json["nextCursor"], str)
+
+    next_cursor = response.json["nextCursor"]
+    response = client.simulate_get(
+        "/items", query_string=f"limit=2&after={next_cursor}"
+    )
+
+    assert response.status_code == 200
+    assert "currentPage" not in response.json
+    assert isinstance(response.json["totalPages"], int)
+    assert len(response.json["statistics"]) == 2
+    assert response.json["statistics"][0]["id"] > next_cursor
+
+
+def test_get_items_invalid_after(client):
+    """Test requesting items after an invalid cursor."""
+
+    response = client.simulate_get("/items", query_string="after=foo")
+
+    assert response.status_code == 400
+
+
+@patch(
+    "dspace_statistics_api.app.get_generation",
+    return_value=(7, datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)),
+)
+def test_get_items_not_modified(mock_get_generation, client):
+    """Test requesting items with the ETag of the current generation."""
+
+    response = client.simulate_get("/items", query_string="limit=1")
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"items-7-1577836800"'
+    assert response.headers["Last-Modified"] == "Wed, 01 Jan 2020 00:00:00 GMT"
+    assert "max-age" in response.headers["Cache-Control"]
+
+    response = client.simulate_get(
+        "/items",
+        query_string="limit=1",
+        headers={"If-None-Match": response.headers["ETag"]},
+    )
+
+    assert response.status_code == 304
+    assert response.text == ""
+
+    response = client.simulate_get(
+        "/items", query_string="limit=1", headers={"If-None-Match": '"items-6"'}
+    )
+
+    assert response.status_code == 200
+
+
+@patch(
+    "dspace_statistics_api.app.get_generation",
+    return_value=(7, datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)),
+)
+def test_get_item_not_modified_since(mock_get_generation, client):
+    """Test requesting a single item that hasn't changed since a date."""
+
+    response = client.simulate_get(
+        "/item/fd8a46d5-1480-4e69-b187-cd3db96d8e4d",
+        headers={"If-Modified-Since": "Thu, 02 Jan 2020 00:00:00 GMT"},
+    )
+
+    assert response.status_code == 304
+
+    response = client.simulate_get(
+        "/item/fd8a46d5-1480-4e69-b187-cd3db96d8e4d",
+        headers={"If-Modified-Since": "Tue, 31 Dec 2019 00:00:00 GMT"},
+    )
+
+    assert response.status_code == 200
+
+
+def test_get_item_cached(client):
+    """Test requesting a single item twice in the same generation."""
+
+    generation = (7, datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
+
+    with patch("dspace_statistics_api.app.get_generation", return_value=generation):
+        response = client.simulate_get("/item/fd8a46d5-1480-4e69-b187-cd3db96d8e4d")
+        hits = client.simulate_get("/status").json["responseCache"]["hits"]
+        cached_response = client.simulate_get(
+            "/item/fd8a46d5-1480-4e69-b187-cd3db96d8e4d"
+        )
+
+        assert cached_response.status_code == 200
+        assert cached_response.content == response.content
+        assert client.simulate_get("/status").json["responseCache"]["hits"] == hits + 1
+
+    # A new generation means the indexer updated the table since
+    generation = (8, datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc))
+
+    with patch("dspace_statistics_api.app.get_generation", return_value=generation):
+        client.simulate_get("/item/fd8a46d5-1480-4e69-b187-cd3db96d8e4d")
+
+        assert client.simulate_get("/status").json["responseCache"]["hits"] == hits + 1
+
+
+def test_get_items_export(client):
+    """Test exporting all items as NDJSON."""
+
+    response = client.simulate_get("/items/export")
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+
+    statistics = [json.loads(line) for line in response.text.splitlines()]
+
+    assert len(statistics) > 0
+    assert isinstance(statistics[0]["id"], str)
+    assert isinstance(statistics[0]["views"], int)
+    assert isinstance(statistics[0]["downloads"], int)
+    assert statistics == sorted(statistics, key=lambda element: element["id"])
+
+
+def test_get_items_export_csv_gzip(client):
+    """Test exporting all items as gzipped CSV."""
+
+    response = client.simulate_get(
+        "/items/export", query_string="format=csv", headers={"Accept-Encoding": "gzip"}
+    )
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "text/csv"
+    assert response.headers["Content-Encoding"] == "gzip"
+
+    rows = list(csv.reader(gzip.decompress(response.content).decode().splitlines()))
+
+    assert rows[0] == ["id", "views", "downloads"]
+    assert len(rows) > 1
+
+
+def test_get_items_export_updated(caplog):
+    """Mock test exporting all items when the indexer updates them during the
+    export, which cuts the response short after the rows we already sent."""
+
+    indexed = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    fetchmany = ExportReader.fetchmany
+
+    # Call the app directly, as the test client doesn't return the part of the
+    # response it read before the exception
+    start_response = MagicMock()
+    body = []
+
+    with patch(
+        "dspace_statistics_api.app.get_generation",
+        side_effect=[(1, indexed), (1, indexed), (2, indexed)],
+    ), patch.object(ExportReader, "fetchmany", lambda self, size: fetchmany(self, 1)):
+        result = app(testing.create_environ(path="/items/export"), start_response)
+
+        with pytest.raises(Exception):
+            for chunk in result:
+                body.append(chunk)
+
+    assert start_response.call_args.args[0] == "200 OK"
+
+    # Only the first batch was sent, and it ended with a complete line
+    lines = b"".join(body).decode().splitlines(keepends=True)
+
+    assert len(lines) == 1
+    assert json.loads(lines[0])["id"]
+    assert lines[0].endswith("\n")
+    assert "Stopped exporting items" in caplog.text
+
+
+def test_get_items_export_invalid_format(client):
+    """Test exporting all items in an invalid format."""
+
+    response = client.simulate_get("/items/export", query_string="format=xml")
+
+    assert response.status_code == 400
+
+
+def test_post_items_lookup(client):
+    """Test looking up an existing and a non-existing item."""
+
+    request_body = {
+        "items": [
+            "fd8a46d5-1480-4e69-b187-cd3db96d8e4d",
+            "c3910974-c3a5-4053-9dce-104aa7bb1620",
+        ]
+    }
+
+    response = client.simulate_post("/items/lookup", json=request_body)
+    response_doc = json.loads(response.text)
+
+    assert response.status_code == 200
+    assert len(response_doc["statistics"]) == 1
+    assert response_doc["statistics"][0]["id"] == "fd8a46d5-1480-4e69-b187-cd3db96d8e4d"
+    assert isinstance(response_doc["statistics"][0]["views"], int)
+    assert isinstance(response_doc["statistics"][0]["downloads"], int)
+    assert response_doc["missing"] == ["c3910974-c3a5-4053-9dce-104aa7bb1620"]
+
+
+def test_post_items_lookup_invalid(client):
+    """Test looking up items with an invalid id in the request body."""
+
+    request_body = {"items": ["fd8a46d5-1480-4e69-b187-cd3db96d8e4d", "foo"]}
+
+    response = client.simulate_post("/items/lookup", json=request_body)
+
+    assert response.status_code == 400
+
+
+def test_post_items_lookup_too_large(client):
+    """Test looking up items with a request body that is too large."""
+
+    request_body = {"items": [str(uuid.UUID(int=i)) for i in range(100)]}
+
+    with patch("dspace_statistics_api.util.POST_MAX_BODY", 1000):
+        response = client.simulate_post("/items/lookup", json=request_body)
+
+    assert response.status_code == 413
+
+
 @pytest.mark.xfail
 def test_post_items_valid_dateFrom(client):
     """Test POSTing a request to /items with a valid dateFrom parameter in the request body."""
@@ -127,6 +367,174 @@ def test_post_items_valid_dateFrom_mocked(client):
     assert isinstance(response.json["statistics"][1]["downloads"], int)
 
 
+def test_post_items_valid_dateFrom_pruned_shards(client):
+    """Mock test POSTing a request to /items with a valid dateFrom parameter to make sure that yearly shards before it are not queried."""
+
+    request_body = {
+        "dateFrom": "2020-06-01T00:00:00Z",
+        "items": [
+            "fd8a46d5-1480-4e69-b187-cd3db96d8e4d",
+            "e53a2eab-1e31-448d-907b-3656ca4e86c1",
+        ],
+    }
+
+    get_statistics_cores_return_value = [
+        "statistics",
+        "statistics-2018",
+        "statistics-2019",
+        "statistics-2020",
+    ]
+
+    solr_response = MagicMock()
+    solr_response.json.return_value = {
+        "facet_counts": {"facet_fields": {"id": {}, "owningItem": {}}}
+    }
+
+    with patch(
+        "dspace_statistics_api.stats.get_statistics_cores",
+        return_value=get_statistics_cores_return_value,
+    ):
+        with patch(
+            "dspace_statistics_api.stats.solr_request", return_value=solr_response
+        ) as solr_request:
+            response = client.simulate_post("/items", json=request_body)
+
+    assert response.status_code == 200
+    assert solr_request.call_count == 2
+    for call in solr_request.call_args_list:
+        assert "statistics-2018" not in call.args[1]["shards"]
+        assert "statistics-2019" not in call.args[1]["shards"]
+        assert "statistics-2020" in call.args[1]["shards"]
+
+
+def test_post_items_terms_filter(client):
+    """Mock test POSTing a request to /items to make sure that Solr is asked for the items with a terms filter."""
+
+    request_body = {
+        "items": [
+            "fd8a46d5-1480-4e69-b187-cd3db96d8e4d",
+            "e53a2eab-1e31-448d-907b-3656ca4e86c1",
+        ],
+    }
+
+    solr_response = MagicMock()
+    solr_response.json.return_value = {
+        "facet_counts": {
+            "facet_fields": {
+                "id": {"fd8a46d5-1480-4e69-b187-cd3db96d8e4d": 21},
+                "owningItem": {"fd8a46d5-1480-4e69-b187-cd3db96d8e4d": 575},
+            }
+        }
+    }
+
+    with patch(
+        "dspace_statistics_api.stats.get_statistics_cores", return_value=["statistics"]
+    ):
+        with patch(
+            "dspace_statistics_api.stats.solr_request", return_value=solr_response
+        ) as solr_request:
+            response = client.simulate_post("/items", json=request_body)
+
+    assert response.status_code == 200
+    assert response.json["statistics"] == [
+        {"id": "fd8a46d5-1480-4e69-b187-cd3db96d8e4d", "views": 21, "downloads": 575},
+        {"id": "e53a2eab-1e31-448d-907b-3656ca4e86c1", "views": 0, "downloads": 0},
+    ]
+    for call in solr_request.call_args_list:
+        assert call.args[1]["q"] == "*:*"
+        assert (
+            f"{{!terms f={call.args[1]['facet.field']}}}fd8a46d5-1480-4e69-b187-cd3db96d8e4d,e53a2eab-1e31-448d-907b-3656ca4e86c1"
+            in call.args[1]["fq"]
+        )
+
+
+def test_post_items_solr_error(client):
+    """Mock test POSTing a request to /items when one of the Solr queries fails."""
+
+    request_body = {"items": ["fd8a46d5-1480-4e69-b187-cd3db96d8e4d"]}
+
+    with patch(
+        "dspace_statistics_api.app.get_views",
+        return_value={"fd8a46d5-1480-4e69-b187-cd3db96d8e4d": 21},
+    ):
+        with patch(
+            "dspace_statistics_api.app.get_downloads",
+            side_effect=requests.exceptions.ConnectionError(),
+        ):
+            response = client.simulate_post("/items", json=request_body)
+
+    assert response.status_code == 502
+
+
+def test_post_items_solr_timeout(client):
+    """Mock test POSTing a request to /items when Solr takes too long to answer."""
+
+    request_body = {"items": ["fd8a46d5-1480-4e69-b187-cd3db96d8e4d"]}
+
+    def get_views(*args):
+        time.sleep(0.5)
+
+        return {"fd8a46d5-1480-4e69-b187-cd3db96d8e4d": 21}
+
+    with patch("dspace_statistics_api.app.SOLR_QUERY_DEADLINE", 0.1):
+        with patch("dspace_statistics_api.app.get_views", side_effect=get_views):
+            with patch(
+                "dspace_statistics_api.app.get_downloads",
+                return_value={"fd8a46d5-1480-4e69-b187-cd3db96d8e4d": 575},
+            ):
+                response = client.simulate_post("/items", json=request_body)
+
+    assert response.status_code == 504
+
+
+def test_post_items_chunked(client):
+    """Mock test POSTing a request to /items with more items than fit in a single Solr query."""
+
+    request_body = {
+        "limit": 250,
+        "items": [str(uuid.UUID(int=i)) for i in range(300)],
+    }
+
+    def get_views(solr_date_string, elements, facet_field, deadline):
+        return {id_: 1 for id_ in elements}
+
+    def get_downloads(solr_date_string, elements, facet_field, deadline):
+        return {id_: 2 for id_ in elements}
+
+    with patch("dspace_statistics_api.app.SOLR_CHUNK_SIZE", 100):
+        with patch(
+            "dspace_statistics_api.app.get_views", side_effect=get_views
+        ) as views:
+            with patch(
+                "dspace_statistics_api.app.get_downloads", side_effect=get_downloads
+            ):
+                response = client.simulate_post("/items", json=request_body)
+
+    assert response.status_code == 200
+    assert response.json["limit"] == 250
+    assert response.json["totalPages"] == 2
+    assert response.json["statistics"] == [
+        {"id": id_, "views": 1, "downloads": 2} for id_ in request_body["items"][:250]
+    ]
+    assert sorted(len(call.args[1]) for call in views.call_args_list) == [
+        50,
+        100,
+        100,
+    ]
+
+
+def test_post_items_invalid_json(client):
+    """Test POSTing a request to /items with a request body that is not valid JSON."""
+
+    response = client.simulate_post(
+        "/items",
+        body='{"items": ["fd8a46d5-1480-4e69-b187-cd3db96d8e4d"',
+        headers={"Content-Type": "application/json"},
+    )
+
+    assert response.status_code == 400
+
+
 def test_post_items_invalid_dateFrom(client):
     """Test POSTing a request to /items with an invalid dateFrom parameter in the request body."""
 
@@ -0,0 +1,608 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+import contextlib
+import datetime
+import io
+import json
+from unittest.mock import MagicMock, patch
+
+import psycopg2
+import psycopg2.extras
+import pytest
+import requests
+
+from dspace_statistics_api.config import (
+    DATABASE_HOST,
+    DATABASE_NAME,
+    DATABASE_PASS,
+    DATABASE_PORT,
+    DATABASE_USER,
+    INDEXER_RECONCILE_INTERVAL,
+)
+from dspace_statistics_api.indexer import (
+    FacetReader,
+    RunContext,
+    create_tables,
+    get_indexing_window,
+    get_stale_shards,
+    index_frozen_shard,
+    is_unchanged,
+    merge_staging,
+    page_facets,
+    stream_facets,
+)
+
+# Ids of the elements in the tests below
+first = "6d5a1c8d-7c59-4b7e-8a1f-8e43a1ff5b8c"
+second = "c3910974-c3a5-4053-9dce-104aa7bb1620"
+third = "fd8a46d5-1480-4e69-b187-cd3db96d8e4d"
+
+
+class TemporaryTables:
+    """A cursor that creates the indexer's unlogged tables as regular ones, as
+    only temporary tables can be created in the session's temporary schema."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query: str, *args):
+        self.cursor.execute(
+            query.replace("CREATE UNLOGGED TABLE", "CREATE TABLE"), *args
+        )
+
+
+@pytest.fixture
+def db():
+    """A database connection with its own temporary copy of the indexer's
+    tables, which the indexer uses instead of the pool's connections, so the
+    tests neither see nor change the statistics that the API tests use."""
+
+    db = psycopg2.connect(
+        f"dbname={DATABASE_NAME} user={DATABASE_USER} password={DATABASE_PASS} host={DATABASE_HOST} port={DATABASE_PORT}",
+        cursor_factory=psycopg2.extras.DictCursor,
+        options="-c search_path=pg_temp",
+    )
+
+    with db.cursor() as cursor:
+        create_tables(TemporaryTables(cursor))
+    db.commit()
+
+    @contextlib.contextmanager
+    def database_manager():
+        yield db
+
+    with patch("dspace_statistics_api.indexer.DatabaseManager", database_manager):
+        yield db
+
+    db.close()
+
+
+def run_context(core_versions: dict = None, now: datetime.datetime = None):
+    now = now or datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+    # Count the statistics core and keep the totals of the yearly shards
+    with patch("dspace_statistics_api.indexer.INDEXER_FROZEN_SHARDS", True):
+        return RunContext(core_versions or {"statistics": 1}, now, now)
+
+
+def insert(db, table: str, rows: list):
+    with db.cursor() as cursor:
+        psycopg2.extras.execute_values(
+            cursor, f"INSERT INTO {table}(id, views, downloads) VALUES %s", rows
+        )
+    db.commit()
+
+
+def select(db, query: str, parameters: list = None):
+    with db.cursor() as cursor:
+        cursor.execute(query, parameters)
+
+        return [tuple(row) for row in cursor.fetchall()]
+
+
+def counts(db, table: str = "items"):
+    return select(db, f"SELECT id::text, views, downloads FROM {table} ORDER BY id")
+
+
+def table_oid(db, table: str = "items"):
+    return select(db, "SELECT %s::regclass::oid", [table])[0][0]
+
+
+def solr_response(xml: str):
+    response = MagicMock()
+    response.raw = io.BytesIO(xml.encode())
+
+    return response
+
+
+def test_stream_facets_field_facets():
+    """Test streaming the counts of a single metric from a regular field facet."""
+
+    xml = """<?xml version="1.0" encoding="UTF-8"?>
+<response>
+  <lst name="responseHeader"><int name="status">0</int></lst>
+  <result name="response" numFound="12" start="0"/>
+  <lst name="facet_counts">
+    <lst name="facet_queries"/>
+    <lst name="facet_fields">
+      <lst name="id">
+        <int name="6d5a1c8d-7c59-4b7e-8a1f-8e43a1ff5b8c">4</int>
+        <int name="fd8a46d5-1480-4e69-b187-cd3db96d8e4d">8</int>
+      </lst>
+    </lst>
+  </lst>
+</response>"""
+
+    with patch(
+        "dspace_statistics_api.indexer.solr_request", return_value=solr_response(xml)
+    ) as solr_request:
+        facets = list(stream_facets("items", ("views",), "id", {}, "statistics"))
+
+    assert facets == [
+        ("6d5a1c8d-7c59-4b7e-8a1f-8e43a1ff5b8c", 4),
+        ("fd8a46d5-1480-4e69-b187-cd3db96d8e4d", 8),
+    ]
+    assert solr_request.call_args.args[0] == "statistics/select"
+    assert solr_request.call_args.args[1]["facet.field"] == "id"
+    assert solr_request.call_args.args[1]["facet.limit"] == -1
+    assert solr_request.call_args.args[1]["wt"] == "xml"
+    solr_request.return_value.close.assert_called_once()
+
+
+def test_stream_facets_json_facets():
+    """Test streaming the counts of several metrics from the buckets of a JSON facet."""
+
+    xml = """<?xml version="1.0" encoding="UTF-8"?>
+<response>
+  <lst name="responseHeader"><int name="status">0</int></lst>
+  <result name="response" numFound="15" start="0"/>
+  <lst name="facets">
+    <long name="count">15</long>
+    <lst name="owningComm">
+      <arr name="buckets">
+        <lst>
+          <str name="val">bde7139c-d321-46bb-aef6-ae70799e5edb</str>
+          <long name="count">12</long>
+          <lst name="views"><long name="count">9</long></lst>
+          <lst name="downloads"><long name="count">3</long></lst>
+        </lst>
+        <lst>
+          <str name="val">c3910974-c3a5-4053-9dce-104aa7bb1620</str>
+          <long name="count">3</long>
+          <lst name="views"><long name="count">0</long></lst>
+          <lst name="downloads"><long name="count">3</long></lst>
+        </lst>
+      </arr>
+    </lst>
+  </lst>
+</response>"""
+
+    with patch(
+        "dspace_statistics_api.indexer.solr_request", return_value=solr_response(xml)
+    ) as solr_request:
+        facets = list(
+            stream_facets(
+                "communities",
+                ("views", "downloads"),
+                "owningComm",
+                {},
+                "statistics",
+            )
+        )
+
+    assert facets == [
+        ("bde7139c-d321-46bb-aef6-ae70799e5edb", 9, 3),
+        ("c3910974-c3a5-4053-9dce-104aa7bb1620", 0, 3),
+    ]
+    assert "json.facet" in solr_request.call_args.args[1]
+
+
+def test_stream_facets_empty():
+    """Test streaming facets when nothing matched the query."""
+
+    field_facets = """<?xml version="1.0" encoding="UTF-8"?>
+<response>
+  <lst name="facet_counts">
+    <lst name="facet_fields"><lst name="id"/></lst>
+  </lst>
+</response>"""
+
+    # Solr leaves the JSON facet out of the response if nothing matched
+    json_facets = """<?xml version="1.0" encoding="UTF-8"?>
+<response>
+  <lst name="facets"><long name="count">0</long></lst>
+</response>"""
+
+    with patch(
+        "dspace_statistics_api.indexer.solr_request",
+        return_value=solr_response(field_facets),
+    ):
+        assert list(stream_facets("items", ("views",), "id", {}, "statistics")) == []
+
+    with patch(
+        "dspace_statistics_api.indexer.solr_request",
+        return_value=solr_response(json_facets),
+    ):
+        facets = stream_facets(
+            "collections", ("views", "downloads"), "owningColl", {}, "statistics"
+        )
+
+        assert list(facets) == []
+
+
+def test_stream_facets_closed():
+    """Test that the response is closed when the caller stops reading early or
+    Solr returned an error."""
+
+    xml = f"""<?xml version="1.0" encoding="UTF-8"?>
+<response>
+  <lst name="facet_counts">
+    <lst name="facet_fields">
+      <lst name="id">
+        <int name="{first}">4</int>
+        <int name="{third}">8</int>
+      </lst>
+    </lst>
+  </lst>
+</response>"""
+
+    response = solr_response(xml)
+
+    with patch("dspace_statistics_api.indexer.solr_request", return_value=response):
+        facets = stream_facets("items", ("views",), "id", {}, "statistics")
+
+        assert next(facets) == (first, 4)
+
+        facets.close()
+
+    response.close.assert_called_once()
+
+    response = solr_response("")
+    response.raise_for_status.side_effect = requests.exceptions.HTTPError()
+
+    with patch("dspace_statistics_api.indexer.solr_request", return_value=response):
+        with pytest.raises(requests.exceptions.HTTPError):
+            list(stream_facets("items", ("views",), "id", {}, "statistics"))
+
+    response.close.assert_called_once()
+
+
+class PagedSolr:
+    """A fake Solr that answers the facet pages of page_facets() from a list of
+    ids, taking a given number of (fake) seconds to answer each page."""
+
+    def __init__(self, ids: list, seconds, timeout=None):
+        self.ids = ids
+        self.seconds = seconds
+        self.timeout = timeout
+        self.now = 0.0
+        self.pages = []
+
+    def monotonic(self):
+        return self.now
+
+    def request(self, path: str, params: dict, read_timeout=None):
+        if "json.facet" in params:
+            facet = json.loads(params["json.facet"])["id"]
+            limit, offset = facet["limit"], facet["offset"]
+        else:
+            limit, offset = params["facet.limit"], params["facet.offset"]
+
+        self.pages.append((offset, limit))
+
+        if self.timeout is not None and limit > self.timeout:
+            raise requests.exceptions.ReadTimeout()
+
+        self.now += self.seconds(limit)
+
+        ids = self.ids[offset:][:limit]
+        if "json.facet" in params:
+            buckets = [
+                {"val": id_, "views": {"count": 1}, "downloads": {"count": 2}}
+                for id_ in ids
+            ]
+            body = {"facets": {"id": {"buckets": buckets}}}
+        else:
+            body = {"facet_counts": {"facet_fields": {"id": {id_: 1 for id_ in ids}}}}
+
+        response = MagicMock()
+        response.json.return_value = body
+        response.content = json.dumps(body).encode()
+
+        return response
+
+    @contextlib.contextmanager
+    def patch(self, **settings):
+        """Patch the indexer to use this Solr, its clock, and page settings,
+        for example size=10 for INDEXER_PAGE_SIZE."""
+
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(
+                patch("dspace_statistics_api.indexer.solr_request", self.request)
+            )
+            time = stack.enter_context(patch("dspace_statistics_api.indexer.time"))
+            time.monotonic = self.monotonic
+
+            for name, value in settings.items():
+                stack.enter_context(
+                    patch(f"dspace_statistics_api.indexer.INDEXER_PAGE_{name}", value)
+                )
+
+            yield
+
+
+def paged_ids(count: int):
+    return [f"00000000-0000-0000-0000-{i:012d}" for i in range(count)]
+
+
+def test_page_facets_page_size():
+    """Test growing the pages while Solr answers quickly, and shrinking them
+    when it is slow, without skipping or repeating any facets."""
+
+    ids = paged_ids(300)
+    # Pages of more than 40 facets are slow
+    solr = PagedSolr(ids, lambda limit: 3 if limit > 40 else 0.5)
+
+    with solr.patch(SIZE=10, SIZE_MIN=5, SIZE_MAX=80, TARGET_SECONDS=2):
+        facets = list(page_facets("items", ("views",), "id", {}, "statistics"))
+
+    assert [limit for offset, limit in solr.pages] == [10, 20, 40, 80, 40, 80, 40]
+    assert [offset for offset, limit in solr.pages] == [0, 10, 30, 70, 150, 190, 270]
+    assert facets == [(id_, 1) for id_ in ids]
+
+
+def test_page_facets_page_bytes():
+    """Test shrinking the pages when Solr's responses are too big, but not
+    below the minimum page size."""
+
+    ids = paged_ids(100)
+    solr = PagedSolr(ids, lambda limit: 0)
+
+    # Each bucket is about 100 bytes
+    with solr.patch(SIZE=40, SIZE_MIN=10, SIZE_MAX=80, TARGET_BYTES=1000):
+        facets = list(
+            page_facets("items", ("views", "downloads"), "id", {}, "statistics")
+        )
+
+    assert [limit for offset, limit in solr.pages][:4] == [40, 20, 10, 10]
+    assert facets == [(id_, 1, 2) for id_ in ids]
+
+
+def test_page_facets_timeout():
+    """Test retrying the same page with smaller pages when Solr times out."""
+
+    ids = paged_ids(50)
+    solr = PagedSolr(ids, lambda limit: 0.5, timeout=20)
+
+    with solr.patch(SIZE=80, SIZE_MIN=10, SIZE_MAX=80):
+        facets = list(page_facets("items", ("views",), "id", {}, "statistics"))
+
+    assert solr.pages[:3] == [(0, 80), (0, 40), (0, 20)]
+    # The pages grow again, and time out again, after the first one
+    assert solr.pages[3:5] == [(20, 40), (20, 20)]
+    assert facets == [(id_, 1) for id_ in ids]
+
+
+def test_page_facets_timeout_minimum():
+    """Test giving up when a page of the minimum size times out."""
+
+    solr = PagedSolr(paged_ids(50), lambda limit: 0.5, timeout=0)
+
+    with solr.patch(SIZE=20, SIZE_MIN=10, SIZE_MAX=80):
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            list(page_facets("items", ("views",), "id", {}, "statistics"))
+
+    assert solr.pages == [(0, 20), (0, 10)]
+
+
+def test_facet_reader_read():
+    """Test reading facets as lines for COPY a few at a time and all at once."""
+
+    facets = [(first, 4, 1), (second, 12, 0), (third, 1, 7)]
+    facet_reader = FacetReader("communities", ("views", "downloads"), iter(facets))
+
+    # Reads stop at the first line that reaches the size
+    assert facet_reader.read(10) == f"{first}\t4\t1\n"
+    assert facet_reader.read() == f"{second}\t12\t0\n{third}\t1\t7\n"
+    assert facet_reader.read() == ""
+    assert facet_reader.total == 3
+
+
+@pytest.mark.parametrize("table_swap", [True, False])
+def test_merge_staging_full(db, table_swap):
+    """Test merging a full recount of one metric, swapping the table or not."""
+
+    insert(db, "items", [(first, 5, 5), (second, 1, 1)])
+    insert(db, "items_staging", [(first, 7, None), (third, 2, None)])
+    oid = table_oid(db)
+
+    with patch("dspace_statistics_api.indexer.INDEXER_TABLE_SWAP", table_swap):
+        context = run_context()
+        merge_staging(context, "items", ("views",), None, context.indexing_until)
+
+    # Elements that weren't counted any more have no views, and the downloads
+    # we didn't count are left alone
+    assert counts(db) == [(first, 7, 5), (second, 0, 1), (third, 2, 0)]
+    assert (table_oid(db) != oid) == table_swap
+    assert select(db, "SELECT to_regclass('items_pkey') IS NOT NULL") == [(True,)]
+    assert select(db, "SELECT watermark, reconciled FROM watermarks") == [
+        (context.indexing_until, context.indexing_until)
+    ]
+    assert select(db, "SELECT generation, total FROM generations") == [(1, 3)]
+    assert counts(db, "items_staging") == []
+
+
+@pytest.mark.parametrize("table_swap", [True, False])
+def test_merge_staging_incremental(db, table_swap):
+    """Test merging incremental counts, which never swaps the table."""
+
+    insert(db, "items", [(first, 5, 5), (second, 1, 1)])
+    # The views and downloads are counted by separate jobs
+    insert(db, "items_staging", [(first, 2, None), (first, None, 1), (third, 3, None)])
+    oid = table_oid(db)
+
+    watermark = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+    with patch("dspace_statistics_api.indexer.INDEXER_TABLE_SWAP", table_swap):
+        context = run_context()
+        merge_staging(context, "items", ("views", "downloads"), watermark, watermark)
+
+    assert counts(db) == [(first, 7, 6), (second, 1, 1), (third, 3, 0)]
+    assert table_oid(db) == oid
+    assert select(
+        db, "SELECT metric, watermark, reconciled FROM watermarks ORDER BY metric"
+    ) == [
+        ("downloads", context.indexing_until, watermark),
+        ("views", context.indexing_until, watermark),
+    ]
+    assert select(db, "SELECT core, version FROM core_versions") == [("statistics", 1)]
+
+
+def test_merge_staging_unchanged(db):
+    """Test that an incremental merge that changes no counts keeps the generation."""
+
+    insert(db, "items", [(first, 5, 5), (second, 1, 1)])
+    insert(db, "items_staging", [(first, 2, None)])
+
+    watermark = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    context = run_context()
+    merge_staging(context, "items", ("views",), watermark, watermark)
+
+    generation = select(db, "SELECT generation, indexed, total FROM generations")
+    assert [row[0] for row in generation] == [1]
+
+    # Nothing happened since the last run
+    merge_staging(context, "items", ("views",), watermark, watermark)
+
+    assert counts(db) == [(first, 7, 5), (second, 1, 1)]
+    assert select(db, "SELECT generation, indexed, total FROM generations") == (
+        generation
+    )
+
+    # An event in the meantime starts a new generation
+    insert(db, "items_staging", [(second, 1, None)])
+    merge_staging(context, "items", ("views",), watermark, watermark)
+
+    assert select(db, "SELECT generation, total FROM generations") == [(2, 2)]
+
+
+def unchanged(db, context):
+    with db.cursor() as cursor:
+        return is_unchanged(context, cursor, "items")
+
+
+def test_is_unchanged(db):
+    """Test skipping a scope only while none of the cores changed since it was
+    counted and it isn't due for a full recount."""
+
+    context = run_context({"statistics": 1, "statistics-2019": 5})
+    merge_staging(
+        context, "items", ("views", "downloads"), None, context.indexing_until
+    )
+
+    assert unchanged(db, context)
+
+    # Solr didn't tell us a core's version
+    assert not unchanged(db, run_context({"statistics": None, "statistics-2019": 5}))
+    # A core was changed, added, or removed
+    assert not unchanged(db, run_context({"statistics": 2, "statistics-2019": 5}))
+    assert not unchanged(
+        db, run_context({"statistics": 1, "statistics-2019": 5, "statistics-2020": 1})
+    )
+    assert not unchanged(db, run_context({"statistics": 1}))
+
+    # Events that happened before we first saw the versions aren't counted
+    # until the watermark has passed them
+    later = context.indexing_until + datetime.timedelta(minutes=5)
+    with db.cursor() as cursor:
+        cursor.execute("UPDATE core_versions SET seen=%s", [later])
+    db.commit()
+
+    assert not unchanged(db, context)
+
+    # The next run counts them
+    context = run_context(context.core_versions, later)
+    merge_staging(context, "items", ("views", "downloads"), None, later)
+
+    assert unchanged(db, context)
+
+    # The last full recount is too old
+    due = context.indexing_until + INDEXER_RECONCILE_INTERVAL
+
+    assert not unchanged(db, run_context(context.core_versions, due))
+
+
+def test_is_unchanged_partial(db):
+    """Test that a run that only counted some of a scope's metrics doesn't let
+    the next run skip the scope."""
+
+    context = run_context()
+    merge_staging(context, "items", ("views",), None, context.indexing_until)
+
+    assert select(db, "SELECT COUNT(*) FROM core_versions") == [(0,)]
+    assert not unchanged(db, context)
+
+    merge_staging(
+        context, "items", ("views", "downloads"), None, context.indexing_until
+    )
+
+    assert unchanged(db, context)
+
+
+def test_frozen_shard_totals(db):
+    """Test storing the totals of a frozen yearly shard and adding them to the
+    counts when recounting everything, and removing them with the shard."""
+
+    xml = f"""<?xml version="1.0" encoding="UTF-8"?>
+<response>
+  <lst name="facet_counts">
+    <lst name="facet_fields">
+      <lst name="id">
+        <int name="{first}">10</int>
+        <int name="{second}">4</int>
+      </lst>
+    </lst>
+  </lst>
+</response>"""
+
+    context = run_context({"statistics": 1, "statistics-2019": 5})
+
+    with patch(
+        "dspace_statistics_api.indexer.solr_request", return_value=solr_response(xml)
+    ) as solr_request:
+        index_frozen_shard(context, "items", ("views",), "id", "statistics-2019", 5)
+
+    # The shard is queried directly rather than through the statistics core
+    assert solr_request.call_args.args[0] == "statistics-2019/select"
+    assert "shards" not in solr_request.call_args.args[1]
+    assert select(db, "SELECT id::text, count FROM shard_totals ORDER BY id") == [
+        (first, 10),
+        (second, 4),
+    ]
+
+    with db.cursor() as cursor:
+        assert get_stale_shards(context, cursor, "items", ("views",)) == []
+        assert get_stale_shards(context, cursor, "items", ("downloads",)) == [
+            "statistics-2019"
+        ]
+        # The totals are only added when recounting everything
+        assert get_indexing_window(context, cursor, "items", ("views",))[0] is None
+
+    # Counts from the statistics core
+    insert(db, "items_staging", [(first, 1, None)])
+    merge_staging(context, "items", ("views",), None, context.indexing_until)
+
+    assert counts(db) == [(first, 11, 0), (second, 4, 0)]
+
+    # Once the shard is gone we have to recount everything without it
+    context = run_context({"statistics": 1})
+
+    with db.cursor() as cursor:
+        assert get_indexing_window(context, cursor, "items", ("views",))[0] is None
+
+    insert(db, "items_staging", [(first, 1, None)])
+    merge_staging(context, "items", ("views",), None, context.indexing_until)
+
+    assert counts(db) == [(first, 1, 0), (second, 0, 0)]
+    assert select(db, "SELECT COUNT(*) FROM shard_totals") == [(0,)]
+    assert select(db, "SELECT COUNT(*) FROM shard_versions") == [(0,)]
@@ -0,0 +1,78 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+from dspace_statistics_api.util import StatisticsCoreRegistry, prune_statistics_cores
+
+
+def solr_error():
+    response = MagicMock()
+    response.status_code = 500
+    response.raise_for_status.side_effect = requests.exceptions.HTTPError(
+        "500 Server Error"
+    )
+
+    return response
+
+
+def test_core_registry_keeps_cores_when_solr_fails(caplog):
+    """Test that the registry keeps the last list of cores when Solr fails to answer."""
+
+    registry = StatisticsCoreRegistry(ttl=3600)
+    registry.cores = ["statistics", "statistics-2019"]
+    registry.refreshing = True
+
+    with patch("dspace_statistics_api.util.solr_request", return_value=solr_error()):
+        with pytest.raises(requests.exceptions.HTTPError):
+            registry.refresh()
+
+        registry.background_refresh()
+
+    assert registry.cores == ["statistics", "statistics-2019"]
+    assert not registry.refreshing
+    assert "Failed to refresh the list of Solr statistics cores" in caplog.text
+
+
+def test_core_registry_without_cores_raises_when_solr_fails():
+    """Test that the registry doesn't assume there are no yearly shards when Solr fails to answer."""
+
+    registry = StatisticsCoreRegistry(ttl=3600)
+
+    with patch("dspace_statistics_api.util.solr_request", return_value=solr_error()):
+        with pytest.raises(requests.exceptions.HTTPError):
+            registry.get()
+
+    assert registry.cores is None
+
+
+def test_prune_statistics_cores():
+    """Test leaving out the yearly shards that can't overlap with a date range."""
+
+    cores = ["statistics", "statistics-2018", "statistics-2019", "statistics-2021"]
+
+    assert prune_statistics_cores(cores, "[2019-06-01T00:00:00Z TO *]") == [
+        "statistics",
+        "statistics-2019",
+        "statistics-2021",
+    ]
+    # Events on the first or last day of a year may be in the shard of the
+    # year before or after
+    assert prune_statistics_cores(cores, "[2019-01-01T00:00:00Z TO *]") == cores
+    assert prune_statistics_cores(cores, "[* TO 2017-12-31T00:00:00Z]") == [
+        "statistics",
+        "statistics-2018",
+    ]
+
+
+def test_prune_statistics_cores_extreme_dates():
+    """Test date ranges at the very start and end of what dates can represent."""
+
+    cores = ["statistics", "statistics-2018"]
+
+    assert (
+        prune_statistics_cores(cores, "[0001-01-01T00:00:00Z TO 9999-12-31T00:00:00Z]")
+        == cores
+    )